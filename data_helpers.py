@@ -1,12 +1,27 @@
+import atexit
+import hashlib
+import html
 import json
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 import requests
 import pandas as pd
 import streamlit as st
-from bs4 import BeautifulSoup
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Callable
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import dateutil.parser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from unidecode import unidecode
+from stub_server import fixture_key, record_response, start_replay_server
 
 # API Helpers
 FPL_BASE = "https://fantasy.premierleague.com/api"
@@ -64,16 +79,318 @@ FPL_TO_FOTMOB_ID = {
     20: 8602   # Wolves
 }
 
+# --- NEW: Shared HTTP Session ---
+# One pooled keep-alive session per process instead of a fresh TCP+TLS handshake per call.
+# The pool is sized to the widest fan-out we run (player history fetches in fpl_logic).
+HTTP_POOL_SIZE = 20
+HTTP_TIMEOUT = 10
+HTTP_RETRY_TOTAL = 3
+HTTP_RETRY_BACKOFF = 0.5   # 0.5s, 1s, 2s between attempts
+HTTP_RETRY_BACKOFF_MAX = 8.0
+HTTP_RETRY_STATUSES = (500, 502, 503, 504) # 429 is handled by the per-host limiter below
+
+_session = None
+_session_lock = threading.Lock()
+
+class _UpstreamRetry(Retry):
+    # Leave 429 + Retry-After to the per-host limiter so throttling is seen and adapted to
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+def _build_retry() -> Retry:
+    kwargs = dict(
+        total=HTTP_RETRY_TOTAL,
+        connect=HTTP_RETRY_TOTAL,
+        read=HTTP_RETRY_TOTAL,
+        status=HTTP_RETRY_TOTAL,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    try:
+        return _UpstreamRetry(backoff_max=HTTP_RETRY_BACKOFF_MAX, **kwargs)
+    except TypeError:
+        # urllib3 < 2 has no backoff_max argument (fixed 120s cap)
+        return _UpstreamRetry(**kwargs)
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the process-wide pooled session (created lazily, thread-safe).
+    requests.Session is safe to share for plain GETs; the adapter pool does the locking.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                    pool_block=True,
+                    max_retries=_build_retry()
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({'Connection': 'keep-alive'})
+                _session = session
+    return _session
+
+# --- NEW: Adaptive Per-host Rate Limiting ---
+# Token bucket + concurrency cap per upstream host (FPL, Understat, FotMob).
+# 429 -> halve rate and concurrency and pause the whole host (Retry-After, bounded);
+# fast successes -> grow concurrency back one step at a time (AIMD); slow responses -> shrink by one.
+HOST_RATE_LIMITS = {
+    'fantasy.premierleague.com': {'rate': 20.0, 'burst': 20, 'max_concurrency': HTTP_POOL_SIZE},
+    'understat.com': {'rate': 1.0, 'burst': 2, 'max_concurrency': 2},
+    'www.fotmob.com': {'rate': 5.0, 'burst': 10, 'max_concurrency': 8},
+}
+DEFAULT_HOST_RATE_LIMIT = {'rate': 10.0, 'burst': 10, 'max_concurrency': 10}
+TARGET_LATENCY = 1.5          # seconds; slower responses shrink concurrency
+MIN_RATE_FRACTION = 0.1       # never throttle below 10% of the configured rate
+THROTTLE_COOLDOWN_MAX = 60.0  # cap on Retry-After / backoff pauses
+
+class HostLimiter:
+    """Adaptive token bucket and concurrency limiter for one upstream host."""
+
+    def __init__(self, host: str, rate: float, burst: int, max_concurrency: int):
+        self.host = host
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self._ok_streak = 0
+        self._throttle_streak = 0
+        self._cond = threading.Condition()
+        self.counters = {'requests': 0, 'throttled': 0, 'errors': 0, 'wait_seconds': 0.0, 'latency_seconds': 0.0}
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.cooldown_until:
+                    timeout = self.cooldown_until - now
+                elif self.in_flight >= self.concurrency:
+                    timeout = None # woken by release()
+                elif self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    break
+                self._cond.wait(timeout=timeout)
+            self.counters['wait_seconds'] += time.monotonic() - started
+
+    def release(self, status: Optional[int], latency: float, retry_after: Optional[float] = None):
+        with self._cond:
+            self.in_flight -= 1
+            self.counters['requests'] += 1
+            self.counters['latency_seconds'] += latency
+            if status == 429:
+                self.counters['throttled'] += 1
+                self.concurrency = max(1, self.concurrency // 2)
+                self.rate = max(self.base_rate * MIN_RATE_FRACTION, self.rate / 2)
+                backoff = retry_after if retry_after else HTTP_RETRY_BACKOFF * (2 ** self._throttle_streak)
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + min(backoff, THROTTLE_COOLDOWN_MAX))
+                self._throttle_streak += 1
+                self._ok_streak = 0
+            else:
+                self._throttle_streak = 0
+                if status is None or status >= 400:
+                    self.counters['errors'] += 1
+                if latency > 2 * TARGET_LATENCY:
+                    self.concurrency = max(1, self.concurrency - 1)
+                    self._ok_streak = 0
+                elif status is not None and status < 400 and latency <= TARGET_LATENCY:
+                    self._ok_streak += 1
+                    if self._ok_streak >= self.concurrency: # one step per "window" of fast successes
+                        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                        self.rate = min(self.base_rate, self.rate * 1.25)
+                        self._ok_streak = 0
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            requests_done = self.counters['requests']
+            return {
+                **self.counters,
+                'avg_latency': self.counters['latency_seconds'] / requests_done if requests_done else 0.0,
+                'concurrency': self.concurrency,
+                'rate': round(self.rate, 2),
+                'in_flight': self.in_flight,
+                'cooling_down': time.monotonic() < self.cooldown_until
+            }
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def get_host_limiter(url: str) -> HostLimiter:
+    host = urlsplit(url).hostname or ''
+    limiter = _host_limiters.get(host)
+    if limiter is None:
+        with _host_limiters_lock:
+            limiter = _host_limiters.get(host)
+            if limiter is None:
+                limiter = HostLimiter(host, **HOST_RATE_LIMITS.get(host, DEFAULT_HOST_RATE_LIMIT))
+                _host_limiters[host] = limiter
+    return limiter
+
+def get_throttle_stats() -> Dict[str, Dict]:
+    """Per-host request/throttle counters and the current adaptive limits."""
+    return {host: limiter.snapshot() for host, limiter in list(_host_limiters.items())}
+
+THROTTLE_LOG_INTERVAL = 300 # seconds between throttle-stat log lines
+
+_throttle_log_at = time.monotonic() + THROTTLE_LOG_INTERVAL
+
+def _log_throttle_stats():
+    """Prints one line per host every THROTTLE_LOG_INTERVAL seconds (called after each limited request)."""
+    global _throttle_log_at
+    now = time.monotonic()
+    if now < _throttle_log_at:
+        return
+    _throttle_log_at = now + THROTTLE_LOG_INTERVAL
+    for host, stats in get_throttle_stats().items():
+        print(f"Throttle stats {host}: {stats['requests']} requests, {stats['throttled']} throttled (429), "
+              f"{stats['errors']} errors, waited {stats['wait_seconds']:.1f}s, avg latency {stats['avg_latency']:.2f}s, "
+              f"concurrency {stats['concurrency']}, rate {stats['rate']}/s")
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+# --- NEW: Record / Replay Mode ---
+# FPL_DATA_MODE=record  -> every upstream response is also written to FPL_FIXTURE_DIR (see stub_server.py)
+# FPL_DATA_MODE=replay  -> requests go to a local stand-in serving that directory (started in-process,
+#                          or an external one at FPL_REPLAY_URL); no upstream traffic, no rate limiting
+DATA_MODE = os.environ.get("FPL_DATA_MODE", "live").lower()
+FIXTURE_DIR = os.environ.get("FPL_FIXTURE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "recorded"))
+REPLAY_URL = os.environ.get("FPL_REPLAY_URL")
+
+_replay_server = None
+_replay_lock = threading.Lock()
+
+def _replay_base_url() -> str:
+    global _replay_server
+    if REPLAY_URL:
+        return REPLAY_URL.rstrip("/")
+    with _replay_lock:
+        if _replay_server is None:
+            _replay_server = start_replay_server(FIXTURE_DIR)
+    return f"http://127.0.0.1:{_replay_server.server_address[1]}"
+
+def replay_url(url: str) -> str:
+    """Where a live URL is served from in replay mode."""
+    return f"{_replay_base_url()}/{fixture_key(url)}"
+
+def _http_get(url: str, headers: Optional[Dict] = None, timeout: float = HTTP_TIMEOUT, **kwargs) -> requests.Response:
+    """
+    GET through the pooled session and the host's adaptive limiter (or the replay stand-in).
+    429 responses are retried (up to HTTP_RETRY_TOTAL) after the host cool-down; the last response is returned.
+    """
+    if DATA_MODE == "replay":
+        return get_http_session().get(replay_url(url), headers=headers, timeout=timeout, **kwargs)
+    response = _limited_get(url, headers=headers, timeout=timeout, **kwargs)
+    if DATA_MODE == "record" and response.status_code == 200:
+        try:
+            record_response(FIXTURE_DIR, url, response.content, response.headers.get('Content-Type'), response.headers.get('ETag'))
+        except OSError as e:
+            print(f"Could not record {url}: {e}")
+    return response
+
+def _limited_get(url: str, headers: Optional[Dict] = None, timeout: float = HTTP_TIMEOUT, **kwargs) -> requests.Response:
+    limiter = get_host_limiter(url)
+    for attempt in range(HTTP_RETRY_TOTAL + 1):
+        limiter.acquire()
+        started = time.monotonic()
+        response = None
+        try:
+            response = get_http_session().get(url, headers=headers, timeout=timeout, **kwargs)
+        finally:
+            status = response.status_code if response is not None else None
+            retry_after = _retry_after_seconds(response) if status == 429 else None
+            limiter.release(status, time.monotonic() - started, retry_after)
+            _log_throttle_stats()
+        if status != 429 or attempt == HTTP_RETRY_TOTAL:
+            return response
+        print(f"Throttled (429) by {limiter.host}, retrying {url}")
+        response.close()
+    return response
+
+API_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Referer': 'https://www.fotmob.com/',
+    'Origin': 'https://www.fotmob.com'
+}
+
+# --- NEW: Single-flight Request Coalescing ---
+# Process-wide registry of in-flight calls: concurrent identical requests (e.g. many sessions
+# missing the cache for the same player at once) share one network call and one parsed result.
+# The shared result must be treated as read-only (st.cache_data hands each caller its own copy).
+class _InFlightCall:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+_inflight_calls = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, fn: Callable[[], object]):
+    """Runs fn() once per key at a time; callers arriving while it runs wait for and share its result."""
+    with _inflight_lock:
+        call = _inflight_calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _InFlightCall()
+            _inflight_calls[key] = call
+
+    if not is_leader:
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight_calls.pop(key, None)
+        call.event.set()
+    return call.result
+
 def _fetch(url: str) -> Optional[Dict]:
-    """Helper function to fetch JSON data with robust error handling."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'application/json, text/plain, */*',
-        'Referer': 'https://www.fotmob.com/',
-        'Origin': 'https://www.fotmob.com'
-    }
+    """Helper function to fetch JSON data with robust error handling (coalesced per URL)."""
+    return single_flight(('json', url), lambda: _fetch_json(url))
+
+def _fetch_json(url: str) -> Optional[Dict]:
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = _http_get(url, headers=API_HEADERS)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -88,112 +405,676 @@ def _fetch(url: str) -> Optional[Dict]:
         print(f"Error decoding JSON data from {url}: {e}")
         return None
 
-@st.cache_data(ttl=300)
+# --- NEW: On-disk Snapshot Store ---
+# Large shared payloads (bootstrap-static, fixtures) are kept on disk with their ETag/Last-Modified.
+# A fresh snapshot is served straight from disk; an older one is revalidated with a conditional GET
+# and reused on 304, so a restart or cache expiry does not re-download the whole payload.
+# Record/replay must not be short-circuited by snapshots from live runs -> a per-process temp dir (see snapshot_dir)
+SNAPSHOT_DIR = os.environ.get("FPL_SNAPSHOT_DIR") or (
+    None if DATA_MODE in ("record", "replay")
+    else os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fpl_cache")
+)
+SNAPSHOT_MAX_AGE = 300
+
+_snapshot_dir_lock = threading.Lock()
+
+def snapshot_dir() -> str:
+    """
+    SNAPSHOT_DIR, created lazily as a temp dir in record/replay mode without FPL_SNAPSHOT_DIR.
+    The temp dir is exported as FPL_SNAPSHOT_DIR so module reloads reuse it, and removed at exit.
+    """
+    global SNAPSHOT_DIR
+    if SNAPSHOT_DIR is None:
+        with _snapshot_dir_lock:
+            if SNAPSHOT_DIR is None:
+                path = os.environ.get("FPL_SNAPSHOT_DIR")
+                if not path:
+                    path = tempfile.mkdtemp(prefix="fpl-snapshots-")
+                    atexit.register(shutil.rmtree, path, ignore_errors=True)
+                    os.environ["FPL_SNAPSHOT_DIR"] = path
+                SNAPSHOT_DIR = path
+    return SNAPSHOT_DIR
+
+def _snapshot_paths(name: str) -> Tuple[str, str]:
+    base = snapshot_dir()
+    return os.path.join(base, f"{name}.json"), os.path.join(base, f"{name}.meta.json")
+
+def _atomic_write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load_snapshot(name: str) -> Tuple[Optional[object], Dict]:
+    """Returns (payload, meta) for a stored snapshot, or (None, {}) if missing/corrupt."""
+    body_path, meta_path = _snapshot_paths(name)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            payload = json.loads(f.read())
+        return payload, meta
+    except (OSError, ValueError):
+        return None, {}
+
+def snapshot_saved_at(name: str) -> float:
+    """Last time a snapshot was downloaded or revalidated (0.0 if unknown)."""
+    _, meta_path = _snapshot_paths(name)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return float(json.load(f).get('saved_at', 0.0))
+    except (OSError, ValueError):
+        return 0.0
+
+def _save_snapshot_meta(name: str, meta: Dict):
+    _, meta_path = _snapshot_paths(name)
+    _atomic_write(meta_path, json.dumps(meta).encode("utf-8"))
+
+def _save_snapshot(name: str, url: str, body: bytes, response_headers) -> Dict:
+    body_path, _ = _snapshot_paths(name)
+    meta = {
+        'url': url,
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'saved_at': time.time()
+    }
+    # Body first, then meta: a crash in between leaves old meta that simply fails revalidation
+    _atomic_write(body_path, body)
+    _save_snapshot_meta(name, meta)
+    return meta
+
+def fetch_snapshot(name: str, url: str, max_age: float = SNAPSHOT_MAX_AGE) -> Optional[object]:
+    """
+    Fetches a JSON payload through the on-disk snapshot store.
+    - snapshot younger than max_age -> served from disk, no network
+    - otherwise conditional GET (If-None-Match / If-Modified-Since); 304 -> disk copy
+    - network failure -> last good disk copy (may be stale), or None if there is none
+    """
+    # max_age is part of the key: a caller wanting a fresher copy never shares a laxer caller's result
+    return single_flight(('snapshot', name, max_age), lambda: _fetch_snapshot(name, url, max_age))
+
+def _fetch_snapshot(name: str, url: str, max_age: float) -> Optional[object]:
+    payload, meta = load_snapshot(name)
+    if payload is not None and (time.time() - meta.get('saved_at', 0)) < max_age:
+        return payload
+
+    headers = dict(API_HEADERS)
+    if payload is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = _http_get(url, headers=headers)
+        if response.status_code == 304 and payload is not None:
+            meta['saved_at'] = time.time()
+            _save_snapshot_meta(name, meta)
+            return payload
+        response.raise_for_status()
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error refreshing snapshot '{name}' from {url}: {e}") # Log to console
+        return payload
+
+    try:
+        _save_snapshot(name, url, response.content, response.headers)
+    except OSError as e:
+        print(f"Could not write snapshot '{name}': {e}")
+    return data
+
+# --- NEW: Deadline-aware Cache TTLs ---
+# Freshness windows come from the gameweek calendar already in bootstrap/fixtures:
+#   live         -> a match is in progress (kickoff .. kickoff + MATCH_WINDOW)
+#   deadline     -> within DEADLINE_WINDOW either side of a gameweek deadline
+#   price_change -> the nightly FPL price-change window (UTC hours)
+#   idle         -> midweek, nothing changes
+# Idle TTLs are capped at the time left until the next window opens.
+DEFAULT_CACHE_TTL = 300
+MIN_CACHE_TTL = 60
+MAX_CACHE_TTL = 6 * 3600
+MATCH_WINDOW = 2.5 * 3600
+DEADLINE_WINDOW = 3 * 3600
+PRICE_CHANGE_WINDOW_UTC = (0, 2)
+
+ENDPOINT_TTLS = {
+    'bootstrap':      {'live': 120,  'deadline': 120,  'price_change': 300,   'idle': 1800},
+    'fixtures':       {'live': 60,   'deadline': 600,  'price_change': 1800,  'idle': 3600},
+    'entry':          {'live': 300,  'deadline': 120,  'price_change': 900,   'idle': 1800},
+    'entry_picks':    {'live': 300,  'deadline': 120,  'price_change': 900,   'idle': 3600},
+    'entry_history':  {'live': 600,  'deadline': 600,  'price_change': 3600,  'idle': 21600},
+    'player_history': {'live': 300,  'deadline': 900,  'price_change': 1800,  'idle': 3600},
+    'understat':      {'live': 3600, 'deadline': 3600, 'price_change': 21600, 'idle': 21600},
+    'midweek':        {'live': 1800, 'deadline': 1800, 'price_change': 3600,  'idle': 3600},
+}
+
+# (deadline timestamps, kickoff timestamps, in-progress flag) - replaced as a whole on update
+_ttl_schedule = ((), (), False)
+
+def _parse_utc_timestamp(value) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def update_ttl_schedule(events: Optional[List[Dict]] = None, fixtures: Optional[List[Dict]] = None):
+    """Refreshes the calendar used by cache_ttl from bootstrap events and/or fixtures."""
+    global _ttl_schedule
+    deadlines, kickoffs, in_progress = _ttl_schedule
+    if events is not None:
+        deadlines = tuple(sorted(ts for ts in (_parse_utc_timestamp(e.get('deadline_time')) for e in events) if ts))
+    if fixtures is not None:
+        kickoffs = tuple(sorted(ts for ts in (_parse_utc_timestamp(f.get('kickoff_time')) for f in fixtures) if ts))
+        in_progress = any(f.get('started') and not f.get('finished_provisional', f.get('finished')) for f in fixtures)
+    _ttl_schedule = (deadlines, kickoffs, in_progress)
+
+def ttl_phase(now: Optional[float] = None) -> Tuple[str, Optional[float]]:
+    """Returns (phase, seconds until the next window opens or closes)."""
+    now = time.time() if now is None else now
+    deadlines, kickoffs, in_progress = _ttl_schedule
+
+    windows = {'live': [(ko, ko + MATCH_WINDOW) for ko in kickoffs],
+               'deadline': [(dl - DEADLINE_WINDOW, dl + DEADLINE_WINDOW) for dl in deadlines]}
+    day_start = now - (now % 86400)
+    price_windows = [(day_start + d * 86400 + PRICE_CHANGE_WINDOW_UTC[0] * 3600,
+                      day_start + d * 86400 + PRICE_CHANGE_WINDOW_UTC[1] * 3600) for d in (0, 1)]
+    windows['price_change'] = price_windows
+
+    boundaries = [edge - now for spans in windows.values() for span in spans for edge in span if edge > now]
+    next_change = min(boundaries) if boundaries else None
+
+    for phase in ('live', 'deadline', 'price_change'):
+        if any(start <= now < end for start, end in windows[phase]):
+            return phase, next_change
+    if in_progress:
+        # Kickoff times can move; trust the API flag while a match is still running
+        return 'live', next_change
+    return 'idle', next_change
+
+def cache_ttl(endpoint: str, now: Optional[float] = None) -> int:
+    """Seconds a cached response for `endpoint` stays fresh at `now`."""
+    table = ENDPOINT_TTLS.get(endpoint)
+    if not table or (not _ttl_schedule[0] and not _ttl_schedule[1]):
+        return DEFAULT_CACHE_TTL # No calendar yet (cold start)
+    phase, next_change = ttl_phase(now)
+    ttl = table[phase]
+    if next_change is not None:
+        ttl = min(ttl, max(MIN_CACHE_TTL, next_change))
+    return int(ttl)
+
+def _cache_epoch(endpoint: str) -> Tuple[int, int]:
+    """
+    Cache-key component for st.cache_data loaders: changes every cache_ttl(endpoint) seconds.
+    The decorators use MAX_CACHE_TTL only to bound memory; freshness comes from the epoch.
+    """
+    ttl = cache_ttl(endpoint)
+    return ttl, int(time.time() // ttl)
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=500, show_spinner=False)
+def _load_entry(entry_id: int, cache_epoch: Tuple[int, int]) -> Dict:
+    return _fetch(f"{FPL_BASE}/entry/{entry_id}/") or {}
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=500, show_spinner=False)
+def _load_entry_picks(entry_id: int, event: int, cache_epoch: Tuple[int, int]) -> Dict:
+    return _fetch(f"{FPL_BASE}/entry/{entry_id}/event/{event}/picks/") or {}
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=2000, show_spinner=False)
+def _load_player_history(player_id: int, cache_epoch: Tuple[int, int]) -> Dict:
+    return _fetch(f"{FPL_BASE}/element-summary/{player_id}/") or {}
+
+# --- NEW: Stale-while-revalidate Shared Snapshot ---
+# bootstrap-static + fixtures are held as ONE process-wide snapshot shared by all sessions.
+# Once it goes stale, readers keep getting the last good snapshot while a background worker
+# fetches the next one. Registered derivations (master tables, features) are computed
+# on the new data BEFORE the swap, so readers never mix new data with old derived results.
+# Snapshots are shared: treat their contents as read-only.
+SNAPSHOT_RETRY_AFTER = MIN_CACHE_TTL
+
+_shared_snapshot = None
+_snapshot_lock = threading.Lock() # guards the reference swap and the refresh flag only
+_snapshot_refreshing = False
+_snapshot_derivations = {}
+
+def register_snapshot_derivation(name: str, fn: Callable[[Dict], object]):
+    """Registers fn(snapshot) -> value, computed once per snapshot version (in registration order)."""
+    _snapshot_derivations[name] = fn
+
+def _snapshot_version(bootstrap: Dict, fixtures: List[Dict]) -> str:
+    raw = json.dumps([bootstrap, fixtures], sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+def _fetch_bootstrap_and_fixtures(max_age: float) -> Tuple[Dict, List[Dict], float]:
+    """Returns (bootstrap, fixtures, validated_at) where validated_at is when the data was last confirmed upstream."""
+    bootstrap = fetch_snapshot("bootstrap-static", f"{FPL_BASE}/bootstrap-static/", max_age=max_age) or {}
+    fixtures = fetch_snapshot("fixtures", f"{FPL_BASE}/fixtures/", max_age=max_age) or []
+    update_ttl_schedule(events=bootstrap.get("events") if bootstrap else None, fixtures=fixtures or None)
+    validated_at = min(snapshot_saved_at("bootstrap-static"), snapshot_saved_at("fixtures"))
+    return bootstrap, fixtures, (validated_at or time.time())
+
+def _build_snapshot(bootstrap: Dict, fixtures: List[Dict], version: str, fetched_at: float) -> Dict:
+    snapshot = {'bootstrap': bootstrap, 'fixtures': fixtures, 'version': version,
+                'fetched_at': fetched_at, 'derived': {}, 'derive_lock': threading.RLock()}
+    # Bring the history store up to date first so the feature derivation reads this bootstrap's histories
+    refresh_player_histories(bootstrap, fixtures)
+    for name in list(_snapshot_derivations):
+        get_snapshot_derived(snapshot, name)
+    return snapshot
+
+def get_snapshot_derived(snapshot: Dict, name: str):
+    """Returns a derived value for this snapshot, computing it on first use if the worker didn't."""
+    derived = snapshot['derived']
+    if name in derived:
+        return derived[name]
+    # Per-snapshot lock: building the next snapshot never blocks readers of the current one
+    with snapshot['derive_lock']:
+        if name not in derived:
+            derived[name] = _snapshot_derivations[name](snapshot)
+    return derived[name]
+
+def _snapshot_max_age() -> int:
+    return min(cache_ttl('bootstrap'), cache_ttl('fixtures'))
+
+def _touch_snapshot(current: Dict, fetched_at: float):
+    """Publishes a copy of `current` with a new fetched_at; readers holding the old dict are unaffected."""
+    global _shared_snapshot
+    with _snapshot_lock:
+        if _shared_snapshot is current:
+            _shared_snapshot = dict(current, fetched_at=fetched_at) # same version -> derived values are shared
+
+def _refresh_snapshot_worker():
+    global _shared_snapshot, _snapshot_refreshing
+    try:
+        current = _shared_snapshot
+        bootstrap, fixtures, validated_at = _fetch_bootstrap_and_fixtures(max_age=_snapshot_max_age())
+        if not bootstrap or "elements" not in bootstrap:
+            # Keep serving the old snapshot (if any); try again shortly
+            if current is not None:
+                _touch_snapshot(current, time.time() - _snapshot_max_age() + SNAPSHOT_RETRY_AFTER)
+            return
+        version = _snapshot_version(bootstrap, fixtures)
+        if current is not None and version == current['version']:
+            _touch_snapshot(current, max(validated_at, time.time() - _snapshot_max_age() + SNAPSHOT_RETRY_AFTER))
+            return
+        # No snapshot yet (cold start only had the un-versioned fallback) -> this one becomes the first
+        snapshot = _build_snapshot(bootstrap, fixtures, version, validated_at)
+        with _snapshot_lock:
+            _shared_snapshot = snapshot # atomic reference swap
+    except Exception as e:
+        print(f"Background snapshot refresh failed: {e}")
+    finally:
+        with _snapshot_lock:
+            _snapshot_refreshing = False
+
+def _start_background_refresh():
+    global _snapshot_refreshing
+    with _snapshot_lock:
+        if _snapshot_refreshing:
+            return
+        _snapshot_refreshing = True
+    threading.Thread(target=_refresh_snapshot_worker, name="fpl-snapshot-refresh", daemon=True).start()
+
+def _cold_start_snapshot() -> Dict:
+    """First snapshot of the process: any disk copy is good enough to render; revalidated right after."""
+    global _shared_snapshot
+    if _shared_snapshot is not None:
+        return _shared_snapshot # published while this caller waited
+    bootstrap, fixtures, validated_at = _fetch_bootstrap_and_fixtures(max_age=float('inf'))
+    if not bootstrap or "elements" not in bootstrap:
+        return {'bootstrap': bootstrap, 'fixtures': fixtures, 'version': None,
+                'fetched_at': validated_at, 'derived': {}, 'derive_lock': threading.RLock()}
+    # Built outside _snapshot_lock (derivations include the full feature build); only the publish is locked
+    snapshot = _build_snapshot(bootstrap, fixtures, _snapshot_version(bootstrap, fixtures), validated_at)
+    with _snapshot_lock:
+        if _shared_snapshot is None:
+            _shared_snapshot = snapshot
+        return _shared_snapshot
+
+def get_shared_snapshot() -> Dict:
+    """
+    Returns {'bootstrap', 'fixtures', 'version', 'fetched_at', 'derived', 'derive_lock'} without blocking on the network,
+    except for the very first load in a process (which prefers the on-disk snapshot).
+    """
+    snapshot = _shared_snapshot
+    if snapshot is None:
+        # Concurrent first loads share one build
+        snapshot = single_flight(('snapshot', 'cold-start'), _cold_start_snapshot)
+        if snapshot['version'] is None:
+            return snapshot
+    if time.time() - snapshot['fetched_at'] > _snapshot_max_age():
+        _start_background_refresh()
+    return snapshot
+
 def get_bootstrap() -> Dict:
-    return _fetch(f"{FPL_BASE}/bootstrap-static/") or {}
+    return get_shared_snapshot()['bootstrap']
 
-@st.cache_data(ttl=300)
 def get_fixtures() -> List[Dict]:
-    return _fetch(f"{FPL_BASE}/fixtures/") or []
+    return get_shared_snapshot()['fixtures']
 
-@st.cache_data(ttl=300)
 def get_entry(entry_id: int) -> Dict:
-    return _fetch(f"{FPL_BASE}/entry/{entry_id}/") or {}
+    return _load_entry(entry_id, _cache_epoch('entry'))
 
-@st.cache_data(ttl=300)
 def get_entry_picks(entry_id: int, event: int) -> Dict:
-    return _fetch(f"{FPL_BASE}/entry/{entry_id}/event/{event}/picks/") or {}
+    return _load_entry_picks(entry_id, event, _cache_epoch('entry_picks'))
 
-@st.cache_data(ttl=300)
 def get_player_history(player_id: int) -> Dict:
-    return _fetch(f"{FPL_BASE}/element-summary/{player_id}/") or {}
+    return _load_player_history(player_id, _cache_epoch('player_history'))
 
-@st.cache_data(ttl=300)
-def get_entry_history(entry_id: int) -> Dict:
+# --- NEW: Bulk Element-Summary Fetch ---
+# One bounded, process-wide worker pool shared by every bulk fetch. Workers run the blocking _fetch,
+# so each request still goes through the pooled, retrying session.
+HISTORY_FETCH_CONCURRENCY = HTTP_POOL_SIZE
+
+_fetch_pool = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="fpl-fetch")
+
+def _fetch_many(urls: Dict[int, str], concurrency: int) -> Dict[int, Optional[Dict]]:
+    """Fetches many JSON URLs on the shared pool with at most `concurrency` of them in flight for this call."""
+    gate = threading.BoundedSemaphore(concurrency)
+    futures = {}
+    for key, url in urls.items():
+        gate.acquire() # released when the fetch finishes
+        future = _fetch_pool.submit(_fetch, url)
+        future.add_done_callback(lambda _: gate.release())
+        futures[key] = future
+    return {key: future.result() for key, future in futures.items()}
+
+def _fetch_histories(player_ids: List[int]) -> Dict[int, Optional[List[Dict]]]:
+    """Bulk element-summary fetch; keeps only the 'history' block (None for failed fetches)."""
+    urls = {int(pid): f"{FPL_BASE}/element-summary/{int(pid)}/" for pid in player_ids}
+    if not urls:
+        return {}
+    raw = _fetch_many(urls, HISTORY_FETCH_CONCURRENCY)
+    return {pid: (data.get('history', []) if data else None) for pid, data in raw.items()}
+
+# --- NEW: Incremental Player History Store ---
+# Histories live in a persistent per-player store (under SNAPSHOT_DIR). Each new bootstrap is compared
+# with the signatures the store was built from, and only players whose row changed are re-pulled.
+# The team's finished-fixture count is part of the signature: a player who sat out a match gets a new
+# 0-minute history row without any of the player's bootstrap fields changing.
+HISTORY_STORE_NAME = "player-histories"
+HISTORY_SIGNATURE_FIELDS = ('event_points', 'minutes', 'total_points', 'news')
+
+_history_store = None # {'signatures': {pid: [...]}, 'histories': {pid: [...]}}, swapped as a whole
+_history_lock = threading.Lock()
+
+def _history_store_path() -> str:
+    return os.path.join(snapshot_dir(), f"{HISTORY_STORE_NAME}.json")
+
+def _get_history_store() -> Dict:
+    global _history_store
+    store = _history_store
+    if store is None:
+        with _history_lock:
+            if _history_store is None:
+                try:
+                    with open(_history_store_path(), "rb") as f:
+                        raw = json.loads(f.read())
+                    _history_store = {
+                        'signatures': {int(k): v for k, v in raw.get('signatures', {}).items()},
+                        'histories': {int(k): v for k, v in raw.get('histories', {}).items()}
+                    }
+                except (OSError, ValueError, AttributeError):
+                    _history_store = {'signatures': {}, 'histories': {}}
+            store = _history_store
+    return store
+
+def _merge_histories(fetched: Dict[int, Optional[List[Dict]]], signatures: Dict[int, list]) -> Dict:
+    """Swaps in a new store with the successful fetches; failed players keep their old history and signature."""
+    global _history_store
+    with _history_lock:
+        store = _history_store
+        new_signatures = dict(store['signatures'])
+        new_histories = dict(store['histories'])
+        for pid, history in fetched.items():
+            if history is None:
+                continue
+            new_histories[pid] = history
+            if pid in signatures:
+                new_signatures[pid] = signatures[pid]
+        _history_store = {'signatures': new_signatures, 'histories': new_histories}
+        return _history_store
+
+def _history_signatures(bootstrap: Dict, fixtures: List[Dict]) -> Dict[int, list]:
+    finished = {}
+    for fixture in fixtures or []:
+        if fixture.get('finished') or fixture.get('finished_provisional'):
+            for side in ('team_h', 'team_a'):
+                finished[fixture.get(side)] = finished.get(fixture.get(side), 0) + 1
+    return {
+        int(el['id']): [el.get(field) for field in HISTORY_SIGNATURE_FIELDS] + [finished.get(el.get('team'), 0)]
+        for el in bootstrap.get('elements', [])
+    }
+
+def refresh_player_histories(bootstrap: Dict, fixtures: List[Dict]) -> int:
+    """
+    Re-pulls element-summary only for players whose bootstrap data changed since the stored copy.
+    Returns the number of players refetched.
+    """
+    signatures = _history_signatures(bootstrap, fixtures)
+    store = _get_history_store()
+    changed = [pid for pid, sig in signatures.items()
+               if store['signatures'].get(pid) != sig or pid not in store['histories']]
+    if not changed:
+        return 0
+
+    fetched = _fetch_histories(changed)
+    store = _merge_histories(fetched, signatures)
+    failed = sum(1 for history in fetched.values() if history is None)
+    print(f"Player histories: refetched {len(changed)}/{len(signatures)} changed players ({failed} failed)")
+    try:
+        payload = {'signatures': store['signatures'], 'histories': store['histories']}
+        _atomic_write(_history_store_path(), json.dumps(payload).encode("utf-8"))
+    except OSError as e:
+        print(f"Could not save player history store: {e}")
+    return len(changed)
+
+def missing_player_histories(player_ids) -> List[int]:
+    """Ids with nothing in the history store (their last fetch failed). No network."""
+    histories = _get_history_store()['histories']
+    return [int(pid) for pid in player_ids if int(pid) not in histories]
+
+def get_player_histories(player_ids: Tuple[int, ...]) -> Dict[int, Dict]:
+    """
+    Bulk version of get_player_history, served from the incremental history store.
+    Players missing from the store are fetched on demand; players whose fetch failed map to {}.
+    """
+    ids = [int(pid) for pid in player_ids]
+    store = _get_history_store()
+    missing = [pid for pid in ids if pid not in store['histories']]
+    if missing:
+        # No signature recorded -> the next refresh re-pulls them against the current bootstrap
+        store = _merge_histories(_fetch_histories(missing), {})
+    histories = store['histories']
+    # Copies: callers sort/modify the lists, the store is shared between sessions
+    return {pid: ({'history': list(histories[pid])} if pid in histories else {}) for pid in ids}
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=500, show_spinner=False)
+def _load_entry_history(entry_id: int, cache_epoch: Tuple[int, int]) -> Dict:
     return _fetch(f"{FPL_BASE}/entry/{entry_id}/history/") or {}
 
-@st.cache_data(ttl=3600)
+def get_entry_history(entry_id: int) -> Dict:
+    return _load_entry_history(entry_id, _cache_epoch('entry_history'))
+
 def get_understat_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Fetches player and team data from Understat.com."""
+    return _load_understat_data(_cache_epoch('understat'))
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=2, show_spinner=False)
+def _load_understat_data(cache_epoch: Tuple[int, int]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    return single_flight(('understat',), _fetch_understat)
+
+# --- NEW: Streaming Understat Extractor ---
+# The league page embeds its data as `var playersData = JSON.parse('\x5B...');` script literals.
+# Instead of building the whole DOM, the body is streamed and scanned at byte level; bytes before a
+# block are dropped as we go and reading stops as soon as both blocks are found.
+UNDERSTAT_URL = "https://understat.com/league/EPL"
+UNDERSTAT_TIMEOUT = (HTTP_TIMEOUT, 30) # (connect, read)
+UNDERSTAT_CHUNK_SIZE = 64 * 1024
+_UNDERSTAT_BLOCK_START = re.compile(rb"var (\w+)\s*=\s*JSON\.parse\('")
+_UNDERSTAT_MARKER_TAIL = 64 # bytes kept between chunks so a marker split across chunks is still found
+
+def _extract_js_blocks(chunks, names: Tuple[str, ...]) -> Dict[str, bytes]:
+    """Returns {name: raw escaped payload} for each `var <name> = JSON.parse('<payload>');` found in the byte stream."""
+    pending = set(names)
+    found = {}
+    buf = bytearray()
+    current = None
+    scan_from = 0
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            if current is None:
+                match = _UNDERSTAT_BLOCK_START.search(buf)
+                if match is None:
+                    del buf[:max(0, len(buf) - _UNDERSTAT_MARKER_TAIL)]
+                    break
+                name = match.group(1).decode("ascii")
+                del buf[:match.end()]
+                if name in pending:
+                    current, scan_from = name, 0
+                continue
+            end = buf.find(b"');", scan_from)
+            newline = buf.find(b"\n", scan_from, end if end >= 0 else len(buf))
+            if newline >= 0:
+                # Payloads are single-line literals; anything else is not one of ours
+                current = None
+                continue
+            if end < 0:
+                scan_from = max(0, len(buf) - 2)
+                break
+            found[current] = bytes(buf[:end])
+            pending.discard(current)
+            del buf[:end + 3]
+            current = None
+            if not pending:
+                return found
+    return found
+
+def _decode_js_block(raw: bytes):
+    # Same decoding the page needs in the browser: \xNN / \uNNNN escapes, then JSON
+    return json.loads(raw.decode('unicode_escape'))
+
+def _understat_players_frame(players: List[Dict]) -> pd.DataFrame:
+    return pd.DataFrame({
+        'id': [p['id'] for p in players],
+        'player_name': [p['player_name'] for p in players],
+        'team_title': [p['team_title'] for p in players],
+        'xG': pd.to_numeric([p['xG'] for p in players], errors='coerce'),
+        'xA': pd.to_numeric([p['xA'] for p in players], errors='coerce'),
+    })
+
+def _understat_teams_frame(teams: Dict) -> pd.DataFrame:
+    titles, xpts = [], []
+    for team_data in teams.values():
+        if team_data.get('history'):
+            titles.append(team_data.get('title'))
+            xpts.append(team_data['history'][-1].get('xpts', 0))
+    return pd.DataFrame({'title': titles, 'xpts': pd.to_numeric(xpts, errors='coerce')})
+
+def _fetch_understat() -> Tuple[pd.DataFrame, pd.DataFrame]:
     try:
-        url = "https://understat.com/league/EPL"
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
         }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        scripts = soup.find_all('script')
-        
-        players_data_str = None
-        teams_data_str = None
-        
-        for script in scripts:
-            if script.string and 'playersData' in script.string:
-                players_data_str = script.string
-            if script.string and 'teamsData' in script.string:
-                teams_data_str = script.string
+        with _http_get(UNDERSTAT_URL, headers=headers, timeout=UNDERSTAT_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            blocks = _extract_js_blocks(response.iter_content(UNDERSTAT_CHUNK_SIZE), ('playersData', 'teamsData'))
 
-        # Process Players
         players_df = pd.DataFrame()
-        if players_data_str:
-            match = re.search(r"var playersData\s*=\s*JSON\.parse\('(.+?)'\);", players_data_str)
-            if match:
-                json_data = match.group(1).encode('utf-8').decode('unicode_escape')
-                players_data = json.loads(json_data)
-                players_df = pd.DataFrame(players_data)
-                players_df['xG'] = pd.to_numeric(players_df['xG'], errors='coerce')
-                players_df['xA'] = pd.to_numeric(players_df['xA'], errors='coerce')
-                players_df = players_df[['id', 'player_name', 'team_title', 'xG', 'xA']]
-            
-        # Process Teams
+        if 'playersData' in blocks:
+            players_df = _understat_players_frame(_decode_js_block(blocks.pop('playersData')))
+
         teams_df = pd.DataFrame()
-        if teams_data_str:
-            match = re.search(r"var teamsData\s*=\s*JSON\.parse\('(.+?)'\);", teams_data_str)
-            if match:
-                json_data = match.group(1).encode('utf-8').decode('unicode_escape')
-                teams_data = json.loads(json_data)
-                team_list = []
-                for team_id_key, team_data in teams_data.items():
-                    if team_data.get('history'):
-                        latest_stats = team_data['history'][-1]
-                        team_list.append({
-                            'title': team_data.get('title'),
-                            'xpts': latest_stats.get('xpts', 0)
-                        })
-                teams_df = pd.DataFrame(team_list)
-                teams_df['xpts'] = pd.to_numeric(teams_df['xpts'], errors='coerce')
+        if 'teamsData' in blocks:
+            teams_df = _understat_teams_frame(_decode_js_block(blocks.pop('teamsData')))
 
         return players_df, teams_df
 
     except Exception as e:
+        print(f"Error fetching Understat data: {e}")
         return pd.DataFrame(), pd.DataFrame()
 
-def check_name_match(fpl_name: str, understat_name: str) -> bool:
-    if not fpl_name or not understat_name:
-        return False
-    fpl_name_lower = str(fpl_name).lower()
-    understat_name_lower = str(understat_name).lower()
-    if fpl_name_lower in understat_name_lower:
-        return True
-    try:
-        fpl_last = fpl_name_lower.split(' ')[-1]
-        understat_last = understat_name_lower.split(' ')[-1]
-        if fpl_last == understat_last:
-            return True
-    except Exception:
-        pass
-    return False
+# --- NEW: Indexed Understat <-> FPL Player Matching ---
+# Candidate pairs come from a few per-team merges on normalized name keys, tier by tier in
+# decreasing confidence. A tier only assigns pairs that are unique on BOTH sides among players
+# still unmatched; players left ambiguous at a tier are not guessed at by the weaker tiers.
+NAME_MATCH_TIERS = ('full_name', 'web_name', 'surname', 'tokens')
+
+@lru_cache(maxsize=None)
+def normalize_name(name) -> str:
+    """ASCII, lower-case, punctuation-free name used as the matching key."""
+    text = unidecode(html.unescape(str(name))).lower()
+    text = re.sub(r"[-.]", " ", text).replace("'", "")
+    return " ".join(text.split())
+
+def _candidate_pairs(left: pd.DataFrame, right: pd.DataFrame, left_on: str, right_on: str, tier: int) -> pd.DataFrame:
+    pairs = left.merge(right, left_on=['team', left_on], right_on=['team', right_on])
+    return pairs[['us_idx', 'fpl_idx']].assign(tier=tier)
+
+def match_understat_players(us_players: pd.DataFrame, fpl_players: pd.DataFrame) -> pd.DataFrame:
+    """
+    One-to-one matches between Understat rows (needs 'fpl_team_id', 'player_name') and FPL rows
+    (needs 'team', 'web_name'; 'first_name'/'second_name' enable the full-name tier).
+    Returns a frame of (us_idx, fpl_idx, tier) using the inputs' index labels.
+    """
+    us = pd.DataFrame({
+        'us_idx': us_players.index,
+        'team': us_players['fpl_team_id'].values,
+        'name': us_players['player_name'].map(normalize_name).values
+    }).dropna(subset=['team'])
+    us['team'] = us['team'].astype(int)
+    fpl = pd.DataFrame({
+        'fpl_idx': fpl_players.index,
+        'team': fpl_players['team'].astype(int).values,
+        'web': fpl_players['web_name'].map(normalize_name).values
+    })
+    us['surname'] = us['name'].str.rsplit(' ', n=1).str[-1]
+    fpl['surname'] = fpl['web'].str.rsplit(' ', n=1).str[-1]
+
+    candidates = []
+    if {'first_name', 'second_name'} <= set(fpl_players.columns):
+        full_names = fpl_players['first_name'].astype(str) + " " + fpl_players['second_name'].astype(str)
+        fpl['full'] = full_names.map(normalize_name).values
+        candidates.append(_candidate_pairs(us, fpl, 'name', 'full', 0))
+    candidates.append(_candidate_pairs(us, fpl, 'name', 'web', 1))
+    candidates.append(_candidate_pairs(us, fpl, 'surname', 'surname', 2))
+
+    # Token tier: every token of the FPL web name appears in the Understat name (e.g. "Gabriel")
+    us_tokens = us[['us_idx', 'team']].assign(token=us['name'].str.split(' ')).explode('token').drop_duplicates()
+    fpl_tokens = fpl[['fpl_idx', 'team']].assign(token=fpl['web'].str.split(' ')).explode('token').drop_duplicates()
+    token_counts = fpl_tokens.groupby('fpl_idx').size()
+    hits = us_tokens.merge(fpl_tokens, on=['team', 'token']).groupby(['us_idx', 'fpl_idx']).size().reset_index(name='hits')
+    hits = hits[hits['hits'].values == token_counts.reindex(hits['fpl_idx']).values]
+    candidates.append(hits[['us_idx', 'fpl_idx']].assign(tier=3))
+
+    pairs = pd.concat(candidates, ignore_index=True)
+    # Best tier per pair; stable sort keeps the result independent of input order within a tier
+    pairs = pairs.sort_values(['tier', 'us_idx', 'fpl_idx'], kind='mergesort').drop_duplicates(['us_idx', 'fpl_idx'])
+
+    matched = []
+    done_us, done_fpl = set(), set()
+    for tier in sorted(pairs['tier'].unique()):
+        open_pairs = pairs[(pairs['tier'] == tier) & ~pairs['us_idx'].isin(done_us) & ~pairs['fpl_idx'].isin(done_fpl)]
+        unique = ~open_pairs['us_idx'].duplicated(keep=False) & ~open_pairs['fpl_idx'].duplicated(keep=False)
+        matched.append(open_pairs[unique])
+        # Matched and ambiguous players are both settled at this tier
+        done_us.update(open_pairs['us_idx'])
+        done_fpl.update(open_pairs['fpl_idx'])
+
+    if not matched:
+        return pd.DataFrame(columns=['us_idx', 'fpl_idx', 'tier'])
+    return pd.concat(matched, ignore_index=True)
 
 @st.cache_data(ttl=3600)
 def merge_understat_data(us_players_df: pd.DataFrame, us_teams_df: pd.DataFrame, fpl_players_df: pd.DataFrame, fpl_teams_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Inputs are shared cached frames -> never modified here
     # Merge Teams
     merged_teams = pd.DataFrame()
     if not us_teams_df.empty and not fpl_teams_df.empty:
         try:
-            us_teams_df['fpl_name'] = us_teams_df['title'].map(UNDERSTAT_TEAM_TO_FPL_NAME)
-            merged_teams = us_teams_df.merge(
+            merged_teams = us_teams_df.assign(fpl_name=us_teams_df['title'].map(UNDERSTAT_TEAM_TO_FPL_NAME)).merge(
                 fpl_teams_df[['name', 'logo_url']], 
                 left_on='fpl_name', 
                 right_on='name',
@@ -208,25 +1089,195 @@ def merge_understat_data(us_players_df: pd.DataFrame, us_teams_df: pd.DataFrame,
     if not us_players_df.empty and not fpl_players_df.empty and not fpl_teams_df.empty:
         try:
             fpl_name_to_id_map = fpl_teams_df.set_index('name')['id'].to_dict()
-            us_players_df['fpl_name'] = us_players_df['team_title'].map(UNDERSTAT_TEAM_TO_FPL_NAME)
-            us_players_df['fpl_team_id'] = us_players_df['fpl_name'].map(fpl_name_to_id_map)
-            
-            fpl_lookup = fpl_players_df[['team', 'web_name', 'photo_url', 'team_short', 'goals_scored', 'assists']].copy()
-            combined_df = us_players_df.merge(fpl_lookup, left_on='fpl_team_id', right_on='team', how='inner')
-            
-            combined_df['name_match'] = combined_df.apply(
-                lambda row: check_name_match(row['web_name'], row['player_name']), axis=1
+            us_players = us_players_df.reset_index(drop=True)
+            us_players = us_players.assign(
+                fpl_team_id=us_players['team_title'].map(UNDERSTAT_TEAM_TO_FPL_NAME).map(fpl_name_to_id_map)
             )
-            final_players = combined_df[combined_df['name_match'] == True].copy()
-            final_players = final_players.sort_values('xG', ascending=False)
-            merged_players = final_players.drop_duplicates(subset=['id', 'player_name'])
-            merged_players = merged_players[['player_name', 'team_short', 'photo_url', 'xG', 'xA', 'goals_scored', 'assists']]
+            fpl_players = fpl_players_df.reset_index(drop=True)
+
+            matches = match_understat_players(us_players, fpl_players)
+            final_players = pd.concat([
+                us_players.loc[matches['us_idx'], ['player_name', 'xG', 'xA']].reset_index(drop=True),
+                fpl_players.loc[matches['fpl_idx'], ['team_short', 'photo_url', 'goals_scored', 'assists']].reset_index(drop=True)
+            ], axis=1)
+            final_players = final_players.sort_values(['xG', 'player_name'], ascending=[False, True], kind='mergesort')
+            merged_players = final_players[['player_name', 'team_short', 'photo_url', 'xG', 'xA', 'goals_scored', 'assists']].reset_index(drop=True)
         except Exception as e:
             st.warning(f"Error merging Understat players: {e}")
 
     return merged_players, merged_teams
 
-@st.cache_data(ttl=3600)
+# --- NEW: Bulk Midweek Fatigue Ingestion ---
+# Fixture lists for all clubs are fetched concurrently (FotMob limiter caps the pace).
+# Finished-match lineups never change, so their parsed minutes are cached permanently
+# (memory + SNAPSHOT_DIR) and each match's details are fetched at most once, even though
+# both clubs of a match point at it.
+LINEUP_CACHE_DIR = "fotmob-lineups"
+MIDWEEK_FETCH_CONCURRENCY = HOST_RATE_LIMITS['www.fotmob.com']['max_concurrency']
+
+_lineup_cache = {}
+_lineup_lock = threading.Lock()
+
+def _fotmob_team_url(fotmob_id: int) -> str:
+    return f"https://www.fotmob.com/api/teams?id={fotmob_id}&ccode3=ENG"
+
+def _fotmob_match_url(match_id) -> str:
+    return f"https://www.fotmob.com/api/matchDetails?matchId={match_id}"
+
+def _last_finished_match(team_data: Optional[Dict], now: datetime) -> Optional[Tuple[datetime, object]]:
+    """(kick-off, match id) of a team's most recent finished fixture, or None."""
+    if not team_data or 'fixtures' not in team_data:
+        return None
+    # fixtures usually contains 'allFixtures' or similar, or just 'fixtures'
+    # The structure can vary, let's look for 'fixtures' key which is usually a list
+    finished_matches = []
+    for fixture in team_data.get('fixtures', []):
+        status = fixture.get('status', {})
+        if not (status.get('finished') or status.get('type') == 'finished'):
+            continue
+        # FotMob dates are ISO strings in status.utcTime
+        date_str = status.get('utcTime')
+        if not date_str:
+            continue
+        try:
+            match_date = dateutil.parser.parse(date_str)
+        except (ValueError, OverflowError):
+            continue
+        if match_date < now:
+            finished_matches.append((match_date, fixture))
+    if not finished_matches:
+        return None
+    last_match_date, last_match_data = max(finished_matches, key=lambda x: x[0])
+    match_id = last_match_data.get('id')
+    return (last_match_date, match_id) if match_id else None
+
+def _played_minutes(player: Dict) -> int:
+    # FotMob often has 'time' as string "90" or "45+2"
+    time_val = player.get('time')
+    if not time_val:
+        return 0
+    try:
+        return int(str(time_val).split('+')[0])
+    except ValueError:
+        return 0
+
+def _parse_lineups(match_details: Dict) -> List[Dict]:
+    """[{'team_id': fotmob id or None, 'player_minutes': {name: minutes}}] for both sides of a match."""
+    lineups = []
+    for team_lineup in match_details.get('content', {}).get('lineup', {}).get('lineup', []):
+        player_minutes = {}
+        # Starters in 'players'; subbed-in players sit in 'bench' with 'time' > 0
+        players = []
+        for entry in team_lineup.get('players', []) + team_lineup.get('bench', []):
+            # Some payloads group starters by formation row (list of lists)
+            players.extend(entry if isinstance(entry, list) else [entry])
+        for player in players:
+            if not isinstance(player, dict):
+                continue
+            name = (player.get('name', {}).get('firstName', '') + " " + player.get('name', {}).get('lastName', '')).strip()
+            mins = _played_minutes(player)
+            if mins > 0:
+                player_minutes[name] = mins
+        lineups.append({'team_id': team_lineup.get('teamId', team_lineup.get('id')), 'player_minutes': player_minutes})
+    return lineups
+
+def _lineup_path(match_id) -> str:
+    return os.path.join(snapshot_dir(), LINEUP_CACHE_DIR, f"{match_id}.json")
+
+def _cached_lineups(match_id) -> Optional[List[Dict]]:
+    lineups = _lineup_cache.get(match_id)
+    if lineups is None:
+        try:
+            with open(_lineup_path(match_id), "rb") as f:
+                lineups = json.loads(f.read())
+            _lineup_cache[match_id] = lineups
+        except (OSError, ValueError):
+            return None
+    return lineups
+
+def _load_lineups(match_ids) -> Dict[object, List[Dict]]:
+    """Parsed lineups per finished match; cached matches cost nothing, the rest are fetched concurrently."""
+    result = {}
+    missing = {}
+    for match_id in set(match_ids):
+        lineups = _cached_lineups(match_id)
+        if lineups is None:
+            missing[match_id] = _fotmob_match_url(match_id)
+        else:
+            result[match_id] = lineups
+    if missing:
+        fetched = _fetch_many(missing, MIDWEEK_FETCH_CONCURRENCY)
+        for match_id, details in fetched.items():
+            lineups = _parse_lineups(details) if details else []
+            result[match_id] = lineups
+            if not lineups:
+                continue # failed / not published yet -> try again next time
+            with _lineup_lock:
+                _lineup_cache[match_id] = lineups
+            try:
+                _atomic_write(_lineup_path(match_id), json.dumps(lineups).encode("utf-8"))
+            except OSError as e:
+                print(f"Could not cache lineup for match {match_id}: {e}")
+    return result
+
+def _team_minutes(lineups: List[Dict], fotmob_id: int) -> Dict[str, int]:
+    """Minutes for one club; falls back to both sides if FotMob did not tag the lineups with team ids."""
+    own = [l for l in lineups if l.get('team_id') is not None and str(l['team_id']) == str(fotmob_id)]
+    player_minutes = {}
+    for lineup in (own or lineups):
+        player_minutes.update(lineup['player_minutes'])
+    return player_minutes
+
+def _minutes_lookup(player_minutes: Dict[str, int]) -> Dict[str, Dict[str, int]]:
+    """Normalized lookups for one club's lineup: full name -> minutes, unambiguous surname -> minutes."""
+    by_name = {}
+    surname_hits = {}
+    for name, mins in player_minutes.items():
+        key = normalize_name(name)
+        by_name[key] = mins
+        surname_hits.setdefault(key.rsplit(' ', 1)[-1], []).append(mins)
+    by_surname = {surname: hits[0] for surname, hits in surname_hits.items() if len(hits) == 1}
+    return {'name': by_name, 'surname': by_surname}
+
+def _build_midweek_index(fpl_team_ids: Tuple[int, ...]) -> Dict[int, Dict]:
+    fotmob_ids = {t: FPL_TO_FOTMOB_ID[t] for t in fpl_team_ids if t in FPL_TO_FOTMOB_ID}
+    if not fotmob_ids:
+        return {}
+    now = datetime.now(timezone.utc)
+    team_pages = _fetch_many({t: _fotmob_team_url(f) for t, f in fotmob_ids.items()}, MIDWEEK_FETCH_CONCURRENCY)
+    last_matches = {}
+    for team_id, team_data in team_pages.items():
+        last_match = _last_finished_match(team_data, now)
+        if last_match:
+            last_matches[team_id] = last_match
+    lineups = _load_lineups(match_id for _, match_id in last_matches.values())
+
+    index = {}
+    for team_id, (match_date, match_id) in last_matches.items():
+        player_minutes = _team_minutes(lineups.get(match_id, []), fotmob_ids[team_id])
+        index[team_id] = {
+            'hours_gap': (now - match_date).total_seconds() / 3600.0,
+            'player_minutes': player_minutes,
+            'minutes_lookup': _minutes_lookup(player_minutes)
+        }
+    return index
+
+@st.cache_data(ttl=MAX_CACHE_TTL, max_entries=4, show_spinner=False)
+def _load_midweek_index(fpl_team_ids: Tuple[int, ...], cache_epoch: Tuple[int, int]) -> Dict[int, Dict]:
+    try:
+        return _build_midweek_index(fpl_team_ids)
+    except Exception as e:
+        print(f"Error fetching FotMob data: {e}")
+        return {}
+
+def get_midweek_index(fpl_team_ids: Tuple[int, ...]) -> Dict[int, Dict]:
+    """
+    get_midweek_data for many clubs at once: {fpl_team_id: {'hours_gap', 'player_minutes', 'minutes_lookup'}}.
+    minutes_lookup holds normalized {'name': {...}, 'surname': {...}} -> minutes maps for joining.
+    Clubs without a finished match (or a failed fetch) are left out.
+    """
+    return _load_midweek_index(tuple(sorted(int(t) for t in fpl_team_ids)), _cache_epoch('midweek'))
+
 def get_midweek_data(fpl_team_id: int) -> Dict:
     """
     Fetches the most recent match data for a team from FotMob to analyze rotation/fatigue.
@@ -236,126 +1287,4 @@ def get_midweek_data(fpl_team_id: int) -> Dict:
             'player_minutes': Dict[str, int] # Map of player name -> minutes played
         }
     """
-    fotmob_id = FPL_TO_FOTMOB_ID.get(fpl_team_id)
-    if not fotmob_id:
-        return {}
-
-    try:
-        # 1. Fetch Team Fixtures
-        url_fixtures = f"https://www.fotmob.com/api/teams?id={fotmob_id}&ccode3=ENG"
-        data = _fetch(url_fixtures)
-        if not data or 'fixtures' not in data:
-            return {}
-
-        # 2. Find last finished match
-        # fixtures usually contains 'allFixtures' or similar, or just 'fixtures'
-        # The structure can vary, let's look for 'fixtures' key which is usually a list
-        fixtures = data.get('fixtures', [])
-        
-        last_match = None
-        now = datetime.now(timezone.utc)
-        
-        # Sort by date descending to find the most recent finished one
-        # FotMob dates are usually ISO strings
-        finished_matches = []
-        for fixture in fixtures:
-            status = fixture.get('status', {})
-            if status.get('finished') or status.get('type') == 'finished':
-                match_time_str = fixture.get('status', {}).get('utcTime') or fixture.get('pageUrl', '').split('/')[-1] # Fallback
-                # Better to use 'utcTime' if available, or 'startTime'
-                # Let's try to parse the date from the fixture object directly if possible
-                # Usually 'status': {'utcTime': ...} or top level 'utcTime'
-                # Let's inspect a typical fixture object structure if we could, but we can't.
-                # We'll assume standard fields.
-                
-                # Try to find a date field
-                date_str = fixture.get('status', {}).get('utcTime')
-                if not date_str:
-                    continue
-                    
-                try:
-                    match_date = dateutil.parser.parse(date_str)
-                    if match_date < now:
-                        finished_matches.append((match_date, fixture))
-                except:
-                    continue
-        
-        if not finished_matches:
-            return {}
-            
-        # Get the most recent one
-        finished_matches.sort(key=lambda x: x[0], reverse=True)
-        last_match_date, last_match_data = finished_matches[0]
-        match_id = last_match_data.get('id')
-        
-        if not match_id:
-            return {}
-
-        # 3. Calculate Gap
-        hours_gap = (now - last_match_date).total_seconds() / 3600.0
-        
-        # 4. Fetch Match Details
-        url_match = f"https://www.fotmob.com/api/matchDetails?matchId={match_id}"
-        match_details = _fetch(url_match)
-        if not match_details:
-            return {'hours_gap': hours_gap, 'player_minutes': {}}
-            
-        # 5. Extract Minutes
-        player_minutes = {}
-        
-        content = match_details.get('content', {})
-        lineup = content.get('lineup', {}).get('lineup', [])
-        
-        # Lineup is usually a list of 2 teams
-        for team_lineup in lineup:
-            # Check if this is our team (optional, but good for safety)
-            # But we can just parse all players since names should be unique enough or we filter later
-            
-            # Starters
-            for player in team_lineup.get('players', []):
-                name = player.get('name', {}).get('firstName', '') + " " + player.get('name', {}).get('lastName', '')
-                name = name.strip()
-                # Minutes usually in 'stats' or top level
-                # If 'time' is present (minutes played)
-                mins = 0
-                # Check for 'time' field or 'stats'
-                # FotMob often has 'time' as string "90" or "45+2"
-                time_val = player.get('time')
-                if time_val:
-                    try:
-                        mins = int(str(time_val).split('+')[0])
-                    except:
-                        mins = 0
-                
-                # Check substitution events if time is missing?
-                # Usually 'time' is reliable for starters who finished or subbed out
-                
-                # If player was subbed ON, they are in 'bench' usually?
-                # Actually FotMob puts subbed-in players in 'bench' list usually, with 'time' > 0
-                
-                if mins > 0:
-                    player_minutes[name] = mins
-                    
-            # Bench
-            for player in team_lineup.get('bench', []):
-                name = player.get('name', {}).get('firstName', '') + " " + player.get('name', {}).get('lastName', '')
-                name = name.strip()
-                mins = 0
-                time_val = player.get('time')
-                if time_val:
-                    try:
-                        mins = int(str(time_val).split('+')[0])
-                    except:
-                        mins = 0
-                
-                if mins > 0:
-                    player_minutes[name] = mins
-
-        return {
-            'hours_gap': hours_gap,
-            'player_minutes': player_minutes
-        }
-
-    except Exception as e:
-        # st.warning(f"Error fetching FotMob data: {e}")
-        return {}
\ No newline at end of file
+    return get_midweek_index((fpl_team_id,)).get(int(fpl_team_id), {})
@@ -10,16 +10,15 @@ st.set_page_config(page_title="FPL Weekly Assistant", page_icon="⚽️", layout
 
 # 2. Import modules
 from data_helpers import (
-    get_bootstrap, get_fixtures, get_entry, get_entry_picks,
-    get_understat_data, merge_understat_data, get_entry_history
+    get_shared_snapshot, get_snapshot_derived, get_entry, get_entry_picks,
+    get_understat_data, merge_understat_data, get_entry_history, get_throttle_stats
 )
 from fpl_logic import (
-    build_master_tables, current_and_next_event, next_fixture_features,
-    engineer_features_enhanced, get_fixture_difficulty_matrix, find_rotation_pairs,
+    get_feature_table, get_fixture_difficulty_matrix, find_rotation_pairs,
     optimize_wildcard_team, optimize_starting_xi, select_captain_vice,
     smart_bench_order, analyze_lineup_insights, calculate_transfer_roi,
     suggest_transfers, POSITIONS, detect_fixture_swing, plan_rolling_transfers,
-    suggest_chip_usage
+    suggest_chip_usage, HIT_COST
 )
 from ui_components import (
     display_user_friendly_table, display_pitch_view, add_global_css,
@@ -126,6 +125,16 @@ def main():
         # Create a reset button outside of the form with an on_click callback
         st.button("Reset", on_click=reset_team_id, help="ล้างค่า ID และรีเฟรชหน้าจอ", type="primary")
 
+        # Per-host limiter counters (FPL / Understat / FotMob) since the app process started
+        with st.expander("📡 API Status (สถานะการเรียก API)"):
+            throttle_stats = get_throttle_stats()
+            if throttle_stats:
+                st.dataframe(pd.DataFrame(throttle_stats).T[
+                    ['requests', 'throttled', 'errors', 'wait_seconds', 'avg_latency', 'concurrency', 'rate', 'cooling_down']
+                ], use_container_width=True)
+            else:
+                st.caption("ยังไม่มีการเรียก API")
+
         st.markdown(
             """
             <hr style="border-top: 1px solid #bbb;">
@@ -144,8 +153,9 @@ def main():
     with loading_placeholder:
         display_loading_overlay()
 
-    bootstrap = get_bootstrap()
-    fixtures = get_fixtures()
+    # Shared snapshot: served immediately, refreshed in the background when stale
+    snapshot = get_shared_snapshot()
+    bootstrap = snapshot['bootstrap']
     
     # Clear loading overlay - MOVED to after processing
     # loading_placeholder.empty()
@@ -155,14 +165,11 @@ def main():
         st.error("⚠️ FPL API กำลังปิดปรับปรุงชั่วคราว")
         st.stop()
         
-    elements, teams, events, fixtures_df = build_master_tables(bootstrap, fixtures)
-    
-    # Drop unhashable columns from fixtures_df to prevent caching errors
-    if 'stats' in fixtures_df.columns:
-        fixtures_df = fixtures_df.drop(columns=['stats'])
+    # Master tables and base features belong to the same snapshot version (stats column already dropped)
+    elements, teams, events, fixtures_df = get_snapshot_derived(snapshot, 'master_tables')
+    base_features = get_feature_table(snapshot)
     
-    cur_event, next_event = current_and_next_event(bootstrap.get("events", []))
-    target_event = next_event or (cur_event + 1 if cur_event else 1)
+    cur_event, target_event = base_features['cur_event'], base_features['target_event']
     
     # Display Deadline
     target_event_info = next((e for e in bootstrap.get("events", []) if e.get("id") == target_event), None)
@@ -175,15 +182,11 @@ def main():
     st.markdown(f"<div style='background-color:#e8f4fd;padding:1rem;border-radius:0.5rem;border-left:5px solid #2b8ad7;font-size:28px;'>📅 GW: <b>{cur_event}</b> | Next: <b>{target_event}</b>{deadline_text}</div>", unsafe_allow_html=True)
 
     # Process Data
-    nf = next_fixture_features(fixtures_df, teams, target_event)
+    nf = base_features['nf']
     us_players, us_teams = get_understat_data()
     
-    # Initial Feature Engineering (Top Players only)
-    # Pass cur_event for avg_minutes fallback logic
-    feat = engineer_features_enhanced(elements, teams, nf, us_players, my_team_ids=None, gameweek=cur_event or 1)
-    feat.set_index('id', inplace=True)
-    # feat.set_index('id', inplace=True) # Already set above if needed, but line 183 does it.
-    # st.write("FPL.py Feat Columns:", feat.columns.tolist()) # REMOVED DEBUG PRINT
+    # Initial Feature Engineering is shared across sessions -> copy before adding per-user columns
+    feat = base_features['feat'].copy()
 
     # Create maps
     feat_sorted = feat.sort_values('web_name')
@@ -193,7 +196,7 @@ def main():
 
     # Dashboard (If not submitted)
     if not st.session_state.get('analysis_submitted', False):
-        opp_matrix, diff_matrix = get_fixture_difficulty_matrix(fixtures_df, teams, target_event)
+        opp_matrix, diff_matrix = get_fixture_difficulty_matrix(fixtures_df, teams, target_event, snapshot_version=snapshot['version'])
         # Pass subset to avoid hashing errors
         rotation_pairs = find_rotation_pairs(
             diff_matrix, 
@@ -202,14 +205,14 @@ def main():
         )
         
         # --- NEW: Fixture Swing Detection ---
-        swing_data = detect_fixture_swing(fixtures_df, teams, target_event)
+        swing_data = detect_fixture_swing(fixtures_df, teams, target_event, snapshot_version=snapshot['version'])
         
         # Pass subsets to avoid hashing errors (TypeError: unhashable type: 'list') and improve performance
         # merge_understat_data is cached, so we want to pass only what it needs
         merged_us_players, merged_us_teams = merge_understat_data(
             us_players, 
             us_teams, 
-            feat[['team', 'web_name', 'photo_url', 'team_short', 'goals_scored', 'assists']], 
+            feat[['team', 'web_name', 'first_name', 'second_name', 'photo_url', 'team_short', 'goals_scored', 'assists']], 
             teams[['id', 'name', 'logo_url']]
         )
         
@@ -350,12 +353,13 @@ def main():
                 current_ids = [p['element'] for p in picks_data]
                 valid_ids = [i for i in current_ids if i in feat.index]
                 
-                # --- FIX: Re-calculate features to ensure user's squad has xMins ---
-                # The initial load might have missed some of the user's players if they aren't in top 250 owned/top 100 points.
-                # We re-run with my_team_ids to force fetch their history.
-                with st.spinner("🔄 Refining player data for your squad..."):
-                     feat = engineer_features_enhanced(elements, teams, nf, us_players, my_team_ids=valid_ids, gameweek=cur_event or 1)
-                     feat.set_index('id', inplace=True)
+                # --- FIX: Make sure the user's squad has real history (xMins) ---
+                # The shared table covers every player; only squad members whose history fetch failed
+                # are retried, and the table is rebuilt only if that retry succeeds.
+                squad_features = get_feature_table(snapshot, my_team_ids=valid_ids)
+                if squad_features is not base_features:
+                     base_features = squad_features
+                     feat = base_features['feat'].copy()
                      
                      # Re-create maps with updated data
                      feat_sorted = feat.sort_values('web_name')
@@ -499,7 +503,7 @@ def main():
                 
                 with st.spinner("Analyzing potential transfers..."):
                     # Pass picks_data to enable Price Lock Analysis
-                    moves = suggest_transfers(valid_ids, bank, free_transfers, feat, transfer_strategy, fixtures_df, teams, target_event, picks_data=picks_data)
+                    moves = suggest_transfers(valid_ids, bank, free_transfers, feat, transfer_strategy, fixtures_df, teams, target_event, picks_data=picks_data, data_version=base_features['version'])
                     with st.container():
                         if moves:
                             moves_df = pd.DataFrame(moves)
@@ -525,7 +529,7 @@ def main():
                             total_out = moves_df['out_cost'].sum()
                             total_in = moves_df['in_cost'].sum()
                             total_hit = moves_df['hit_cost'].sum()
-                            st.info(f"💰 งบประมาณ: ขายออก **£{total_out:.1f}m** | ซื้อเข้า **£{total_in:.1f}m** | เสียแต้ม: **-{total_hit}**")
+                            st.info(f"💰 งบประมาณ: ขายออก **£{total_out:.1f}m** | ซื้อเข้า **£{total_in:.1f}m** | เสียแต้ม: **-{total_hit:g}**")
                             
                             # Add Price Lock Warning to 'Out' column
                             if 'price_loss' in moves_df.columns:
@@ -555,7 +559,9 @@ def main():
                     st.markdown("จำลองแผนการเปลี่ยนตัวล่วงหน้า 3 สัปดาห์ พร้อมประเมินผลต่างแต้มที่คาดว่าได้รับ")
                     
                     with st.spinner("กำลังจำลองแผนการเล่นในอนาคต..."):
-                        pipeline = plan_rolling_transfers(valid_ids, bank, free_transfers, feat, fixtures_df, teams, target_event)
+                        # Same arguments as the suggestions above -> reads the same cached plan
+                        pipeline = plan_rolling_transfers(valid_ids, bank, free_transfers, feat, fixtures_df, teams, target_event,
+                                                          picks_data=picks_data, strategy=transfer_strategy, data_version=base_features['version'])
                         
                         if pipeline:
                             cols = st.columns(len(pipeline))
@@ -569,6 +575,8 @@ def main():
                                     if step['action'] == "TRANSFER":
                                         st.success("🔁 เปลี่ยนตัว")
                                         st.markdown(f"##### {translate_transfer_text(step['details'])}")
+                                        if step.get('hits'):
+                                            st.caption(f"เสียแต้ม: -{step['hits'] * HIT_COST}")
                                         st.metric("แต้มสุทธิที่คาดว่าจะได้", f"{step['net_gain']:.1f}")
                                     else:
                                         st.info("⏸ เก็บ FT")
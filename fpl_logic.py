@@ -1,12 +1,19 @@
+import hashlib
+import threading
+import time
 import numpy as np
 import pandas as pd
 import streamlit as st
-from pulp import LpProblem, LpMaximize, LpVariable, lpSum, LpBinary, LpStatus, PULP_CBC_CMD
-from typing import List, Dict, Tuple, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
-from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
-from data_helpers import get_player_history, get_midweek_data
+from pulp import (
+    LpProblem, LpMaximize, LpVariable, LpAffineExpression, lpSum, LpBinary, LpStatus, PULP_CBC_CMD,
+    LpSolution, LpSolutionOptimal, LpSolutionIntegerFeasible
+)
+from typing import List, Dict, Tuple, Optional, Union
+from data_helpers import (
+    get_player_history, get_player_histories, get_midweek_index, get_understat_data,
+    register_snapshot_derivation, get_snapshot_derived, normalize_name,
+    missing_player_histories, single_flight
+)
 
 POSITIONS = {1: "GK", 2: "DEF", 3: "MID", 4: "FWD"}
 TEAM_MAP_COLS = ["id", "code", "name", "short_name", "strength_overall_home", "strength_overall_away",
@@ -32,10 +39,8 @@ def generate_penalty_takers_map(elements_df: pd.DataFrame, teams_df: pd.DataFram
         team_id = player['team']
         team_short = id_to_short_name.get(team_id)
         
-        # ใช้ web_name (ชื่อหลังเสื้อ)
-        # และใช้ unidecode เพื่อจัดการชื่อที่มีอักขระพิเศษรอไว้เลย
-        from unidecode import unidecode
-        player_name_clean = unidecode(str(player['web_name'])).lower().strip()
+        # ใช้ web_name (ชื่อหลังเสื้อ) แบบ normalize แล้ว (คอลัมน์จาก build_master_tables)
+        player_name_clean = player['web_name_norm'] if 'web_name_norm' in player else normalize_name(player['web_name'])
         
         if team_short:
             if team_short not in penalty_map:
@@ -72,211 +77,375 @@ def build_master_tables(bootstrap: Dict, fixtures: List[Dict]) -> Tuple[pd.DataF
     
     elements = elements.merge(teams[["id","short_name"]], left_on="team", right_on="id", suffixes=("","_team"))
     elements.rename(columns={"short_name":"team_short"}, inplace=True)
+    add_normalized_names(elements)
     fixtures_df = pd.DataFrame(fixtures)
     
     return elements, teams, events, fixtures_df
 
-def next_fixture_features(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, event_id: int) -> pd.DataFrame:
-    next_gw_fixtures = fixtures_df[fixtures_df["event"] == event_id].copy()
-    rows = []
-    team_data = {team_id: {'home_fixtures': [], 'away_fixtures': []} for team_id in teams_df['id'].unique()}
-    teams_idx = teams_df.set_index('id')
-
-    for _, row in next_gw_fixtures.iterrows():
-        home_team_id, away_team_id = row['team_h'], row['team_a']
-        team_data[home_team_id]['home_fixtures'].append(away_team_id)
-        team_data[away_team_id]['away_fixtures'].append(home_team_id)
+# --- NEW: Midweek Minutes Lookup ---
+def midweek_minutes_played(elements: pd.DataFrame, midweek_index: Dict[int, Dict]) -> pd.Series:
+    """
+    Minutes each element played in the last match of the player's club (NaN if not in the lineup).
+    Joins on the per-team lookups built by get_midweek_index, in order of confidence:
+    full name, web name as a full name (single-name players), then surname when unambiguous.
+    """
+    rows = [
+        (team_id, kind, key, mins)
+        for team_id, mw in midweek_index.items()
+        for kind, lookup in mw.get('minutes_lookup', {}).items()
+        for key, mins in lookup.items()
+    ]
+    if not rows:
+        return pd.Series(np.nan, index=elements.index)
+    lookup = pd.DataFrame(rows, columns=['team', 'kind', 'key', 'mins'])
+    by_name = lookup[lookup['kind'] == 'name'].set_index(['team', 'key'])['mins']
+    by_surname = lookup[lookup['kind'] == 'surname'].set_index(['team', 'key'])['mins']
+
+    team = elements['team'].astype(int)
+    surname = elements['web_name_norm'].str.rsplit(' ', n=1).str[-1]
+    mins = by_name.reindex(pd.MultiIndex.from_arrays([team, elements['full_name_norm']])).values
+    mins = pd.Series(mins, index=elements.index, dtype=float)
+    mins = mins.fillna(pd.Series(by_name.reindex(pd.MultiIndex.from_arrays([team, elements['web_name_norm']])).values, index=elements.index))
+    # Surname only counts when it is unique on both sides (lineup and FPL squad)
+    unique_surname = ~pd.DataFrame({'team': team, 'surname': surname}).duplicated(keep=False)
+    by_surname_hit = pd.Series(by_surname.reindex(pd.MultiIndex.from_arrays([team, surname])).values, index=elements.index)
+    mins = mins.fillna(by_surname_hit.where(unique_surname))
+    return mins
+
+# --- NEW: Shared Normalized Names ---
+# Built once per bootstrap (master tables) and reused by every name matcher:
+# penalty takers, the Understat merge and midweek rotation. The keys stay internal:
+# engineer_features_enhanced drops them from the feature table it returns.
+NAME_KEY_COLUMNS = ['web_name_norm', 'full_name_norm']
+
+def add_normalized_names(elements: pd.DataFrame) -> pd.DataFrame:
+    """Adds web_name_norm / full_name_norm (see data_helpers.normalize_name) in place."""
+    elements['web_name_norm'] = elements['web_name'].map(normalize_name)
+    elements['full_name_norm'] = (elements['first_name'].astype(str) + " " + elements['second_name'].astype(str)).map(normalize_name)
+    return elements
 
-    for team_id, fixtures_info in team_data.items():
-        home_opps = fixtures_info['home_fixtures']
-        away_opps = fixtures_info['away_fixtures']
-        num_fixtures = len(home_opps) + len(away_opps)
-        
-        opp_list = []
-        for opp_id in home_opps:
-            opp_list.append(f"{teams_idx.loc[opp_id, 'short_name']} (H)")
-        for opp_id in away_opps:
-            opp_list.append(f"{teams_idx.loc[opp_id, 'short_name']} (A)")
-        
-        if num_fixtures == 0:
-            rows.append({
-                'team': team_id, 'num_fixtures': 0, 
-                'total_opp_def_str': 0, 'total_opp_att_str': 0,
-                'avg_fixture_ease': 0, 'fixture_ease_att': 0, 'fixture_ease_def': 0,
-                'opponent_str': "BLANK"
-            })
-            continue
+# --- NEW: Team × GW Fixture Index ---
+# Who plays whom, where and how often per GW, built once per fixtures content and shared by the
+# fixture analytics (the snapshot worker warms it). 'rows' has one row per team per fixture,
+# ordered by team, GW, home games first, then fixture order; 'counts' is team id × GW
+# (0 = blank, 2+ = double).
+FIXTURE_INDEX_SIZE = 4
+
+_fixture_indexes = {}
+_fixture_index_lock = threading.Lock()
+
+def build_fixture_index(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> Dict:
+    fx = fixtures_df[fixtures_df['event'].notna()]
+    event = fx['event'].to_numpy().astype(int)
+    rows = pd.DataFrame({
+        'team': np.concatenate([fx['team_h'].to_numpy(), fx['team_a'].to_numpy()]),
+        'event': np.concatenate([event, event]),
+        'opponent': np.concatenate([fx['team_a'].to_numpy(), fx['team_h'].to_numpy()]),
+        'is_home': np.repeat([True, False], len(fx))
+    })
+    # Stable sort keeps "home first, then fixture order" inside each (team, GW)
+    rows = rows.sort_values(['team', 'event'], kind='mergesort').reset_index(drop=True)
+    last_gw = max(38, int(event.max())) if len(event) else 38
+    counts = rows.groupby(['team', 'event']).size().unstack('event')
+    counts = counts.reindex(index=teams_df['id'].to_numpy(), columns=range(1, last_gw + 1)).fillna(0).astype(int)
+    return {'rows': rows, 'counts': counts}
+
+def _fixture_key(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> Tuple[str, str]:
+    return frame_fingerprint(fixtures_df[['event', 'team_h', 'team_a']]), frame_fingerprint(teams_df)
+
+def get_fixture_index(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> Dict:
+    """Cached build_fixture_index (shared between sessions -> do not mutate)."""
+    key = _fixture_key(fixtures_df, teams_df)
+    index = _fixture_indexes.get(key)
+    if index is None:
+        index = build_fixture_index(fixtures_df, teams_df)
+        with _fixture_index_lock:
+            _fixture_indexes[key] = index
+            while len(_fixture_indexes) > FIXTURE_INDEX_SIZE:
+                _fixture_indexes.pop(next(iter(_fixture_indexes)))
+    return index
+
+def fixture_rows(index: Dict, gws: List[int]) -> pd.DataFrame:
+    """Index rows (team, event, opponent, is_home) for the given GWs."""
+    rows = index['rows']
+    return rows[rows['event'].isin(gws)]
+
+def fixture_counts(index: Dict, gws: List[int]) -> pd.DataFrame:
+    """team id × GW fixture counts for the given GWs (GWs outside the season count as blanks)."""
+    return index['counts'].reindex(columns=gws, fill_value=0)
+
+def build_snapshot_fixture_index(snapshot: Dict) -> Dict:
+    _, teams, _, fixtures_df = get_snapshot_derived(snapshot, 'master_tables')
+    return get_fixture_index(fixtures_df, teams)
+
+def next_fixture_features(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, event_id: Union[int, List[int]]) -> pd.DataFrame:
+    """
+    Per-team fixture features for a GW: opponent strength totals, ease, opponent labels and venue multiplier.
+    Blanks get num_fixtures 0 / "BLANK"; doubles sum both games.
+    event_id may be a list of GWs: one call then returns every (event, team) row, with an 'event' column.
+    """
+    many = isinstance(event_id, (list, tuple, range, np.ndarray))
+    events = [int(e) for e in event_id] if many else [event_id]
+    teams_idx = teams_df.set_index('id')
+    team_ids = teams_df['id'].unique()
+
+    rows = fixture_rows(get_fixture_index(fixtures_df, teams_df), events)
+    opp_pos = teams_idx.index.get_indexer(rows['opponent'])
+    if (opp_pos < 0).any():
+        raise KeyError(f"Unknown opponent ids: {set(rows['opponent'][opp_pos < 0])}")
+    is_home = rows['is_home'].to_numpy()
+    # One cell per (event, team); home side meets the opponent's away strengths and vice versa
+    cell = pd.Index(events).get_indexer(rows['event']) * len(team_ids) + pd.Index(team_ids).get_indexer(rows['team'])
+    n_cells = len(events) * len(team_ids)
+    opp = teams_idx.iloc[opp_pos]
+    opp_def = np.where(is_home, opp['strength_defence_away'], opp['strength_defence_home'])
+    opp_att = np.where(is_home, opp['strength_attack_away'], opp['strength_attack_home'])
+
+    num_fixtures = np.bincount(cell, minlength=n_cells)
+    home_games = np.bincount(cell, weights=is_home, minlength=n_cells).astype(int)
+    total_def = np.bincount(cell, weights=opp_def, minlength=n_cells).astype(opp_def.dtype)
+    total_att = np.bincount(cell, weights=opp_att, minlength=n_cells).astype(opp_att.dtype)
+    played = num_fixtures > 0
+
+    # Labels in index order: home games first, then fixture order
+    opponents = [[] for _ in range(n_cells)]
+    for c, name, home in zip(cell, opp['short_name'].astype(str), is_home):
+        opponents[c].append(f"{name} ({'H' if home else 'A'})")
+
+    # Normalize Ease (Higher is easier)
+    # Attackers want weak Opponent Defense
+    # Defenders want weak Opponent Attack
+    max_def = teams_idx['strength_defence_home'].max()
+    max_att = teams_idx['strength_attack_home'].max()
+    games_played = np.maximum(num_fixtures, 1)
+    ease_att = np.where(played, 1.0 - (total_def / (games_played * max_def)), 0)
+    ease_def = np.where(played, 1.0 - (total_att / (games_played * max_att)), 0)
+
+    features = pd.DataFrame({
+        'team': np.tile(team_ids, len(events)),
+        'num_fixtures': num_fixtures,
+        'total_opp_def_str': total_def,
+        'total_opp_att_str': total_att,
+        'avg_fixture_ease': ease_att, # Legacy fallback
+        'fixture_ease_att': ease_att, # For Attackers (vs Def)
+        'fixture_ease_def': ease_def, # For Defenders (vs Att)
+        'opponent_str': [", ".join(opps) if opps else "BLANK" for opps in opponents],
+        'venue_multiplier': np.where(played, 1.0 + (home_games * 0.1) - ((num_fixtures - home_games) * 0.1), np.nan)
+    })
+    if not played.any():
+        # No games at all -> integer zeros and no venue_multiplier column (engineer_features_enhanced then uses 1.0)
+        ease_cols = ['avg_fixture_ease', 'fixture_ease_att', 'fixture_ease_def']
+        features[ease_cols] = features[ease_cols].astype(int)
+        features = features.drop(columns=['venue_multiplier'])
+    if many:
+        features.insert(0, 'event', np.repeat(events, len(team_ids)))
+    return features
+
+def calculate_smart_selection_scores(df: pd.DataFrame) -> pd.Series:
+    """Selection score for every row of the feature table (whole-column version of the old per-row score)."""
+    def col(name, default):
+        return df[name] if name in df.columns else pd.Series(default, index=df.index, dtype=float)
+
+    xg, xa = col('xG', 0.0), col('xA', 0.0)
+    score = col('pred_points', 0.0) * 0.4
+
+    has_xgi = (xg > 0) | (xa > 0)
+    games_played_est = np.maximum(1, col('minutes', 0.0) / 90.0)
+    xgi_bonus = (xg * 5 + xa * 3) / games_played_est
+    score = score + np.where(has_xgi, xgi_bonus * 0.3, 0.0)
+
+    score = score + col('form', 0.0) * 0.15
+    score = score + col('avg_fixture_ease', 0.0) * 10 * 0.1
+    score = score + col('avg_fixture_ease', 0.0) * 10 * 0.1
 
-        opponent_str = ", ".join(opp_list)
-        total_opp_def_str = 0
-        total_opp_att_str = 0
-        
-        for opp_id in home_opps:
-            total_opp_def_str += teams_idx.loc[opp_id, 'strength_defence_away']
-            total_opp_att_str += teams_idx.loc[opp_id, 'strength_attack_away']
-        for opp_id in away_opps:
-            total_opp_def_str += teams_idx.loc[opp_id, 'strength_defence_home']
-            total_opp_att_str += teams_idx.loc[opp_id, 'strength_attack_home']
-
-        # Normalize Ease (Higher is easier)
-        # Attackers want weak Opponent Defense
-        # Defenders want weak Opponent Attack
-        max_def = teams_idx['strength_defence_home'].max()
-        max_att = teams_idx['strength_attack_home'].max()
-        
-        rows.append({
-            'team': team_id,
-            'num_fixtures': num_fixtures,
-            'total_opp_def_str': total_opp_def_str,
-            'total_opp_att_str': total_opp_att_str,
-            'avg_fixture_ease': 1.0 - (total_opp_def_str / (num_fixtures * max_def)), # Legacy fallback
-            'fixture_ease_att': 1.0 - (total_opp_def_str / (num_fixtures * max_def)), # For Attackers (vs Def)
-            'fixture_ease_def': 1.0 - (total_opp_att_str / (num_fixtures * max_att)), # For Defenders (vs Att)
-            'opponent_str': opponent_str,
-            'venue_multiplier': 1.0 + (len(home_opps) * 0.1) - (len(away_opps) * 0.1)
-        })
+    # --- IMPROVED: Stricter penalties for unavailable players ---
+    # 0 -> score forced to 0, < 50% -> heavy penalty
+    play_prob = col('play_prob', 1.0)
+    score = score * np.select([play_prob == 0, play_prob < 0.5], [0.0, 0.2], default=0.5 + 0.5 * play_prob)
 
-    return pd.DataFrame(rows)
+    num_fixtures = col('num_fixtures', 1)
+    score = score * np.where(num_fixtures == 2, 1.3, 1.0)
+    return pd.Series(np.where(num_fixtures == 0, 0.0, score), index=df.index)
 
-def calculate_smart_selection_score(player_row):
-    score = 0.0
-    score += player_row.get('pred_points', 0) * 0.4
-    
-    if player_row.get('xG', 0) > 0 or player_row.get('xA', 0) > 0:
-        minutes_played = player_row.get('minutes', 0)
-        games_played_est = max(1, minutes_played / 90.0)
-        xgi_bonus = (player_row.get('xG', 0) * 5 + player_row.get('xA', 0) * 3) / games_played_est
-        score += xgi_bonus * 0.3
-    
-    score += player_row.get('form', 0) * 0.15
-    score += player_row.get('avg_fixture_ease', 0) * 10 * 0.1
-    score += player_row.get('avg_fixture_ease', 0) * 10 * 0.1
-    
-    # --- IMPROVED: Stricter penalties for unavailable players ---
-    play_prob = player_row.get('play_prob', 1.0)
-    if play_prob == 0:
-        score *= 0.0  # Force score to 0 if definitely not playing
-    elif play_prob < 0.5:
-        score *= 0.2  # Heavy penalty for low chance
-    else:
-        score *= (0.5 + 0.5 * play_prob)
-    
-    if player_row.get('num_fixtures', 1) == 2:
-        score *= 1.3
-    if player_row.get('num_fixtures', 1) == 0:
-        score = 0
-    
-    return score
+# Role lists for every (penalty, free kick, corner) combination, indexed by pen*4 + fk*2 + corner
+SET_PIECE_ROLE_COMBOS = np.empty(8, dtype=object)
+for _code in range(8):
+    SET_PIECE_ROLE_COMBOS[_code] = [role for bit, role in zip((4, 2, 1), ('Penalty', 'Free Kick', 'Corner')) if _code & bit]
 
-def analyze_set_piece_role(row: pd.Series) -> Tuple[List[str], str]:
+def analyze_set_piece_roles(df: pd.DataFrame) -> Tuple[pd.Series, pd.Series, np.ndarray, np.ndarray, np.ndarray]:
     """
     Analyzes set piece roles based on API order fields.
-    Returns: (List of roles, Note string)
+    Returns: (Series of role lists, Series of note strings, is_penalty, is_free_kick, is_corner boolean arrays)
+    Rows with the same roles share one (read-only) role list.
     """
-    roles = []
-    notes = []
-    
+    def order(name):
+        if name not in df.columns:
+            return pd.Series(np.nan, index=df.index)
+        return pd.to_numeric(df[name], errors='coerce')
+
     # Penalties (Order 1 = Primary, 2 = Secondary)
-    pen_order = row.get('penalties_order')
-    if pd.notnull(pen_order):
-        if pen_order == 1:
-            roles.append('Penalty')
-            notes.append("Primary Penalty Taker")
-        elif pen_order <= 2:
-            notes.append("Backup Penalty Taker")
-            
-    # Direct Free Kicks
-    fk_order = row.get('direct_freekicks_order')
-    if pd.notnull(fk_order):
-        if fk_order == 1:
-            roles.append('Free Kick')
-            notes.append("Direct Free Kick Taker")
-            
-    # Corners / Indirect FK
-    corner_order = row.get('corners_and_indirect_freekicks_order')
-    if pd.notnull(corner_order):
-        if corner_order == 1:
-            roles.append('Corner')
-            notes.append("Primary Corner Taker")
-        elif corner_order <= 2:
-            notes.append("Shared Corner Duties")
-            
-    return roles, " | ".join(notes)
+    pen_order = order('penalties_order')
+    fk_order = order('direct_freekicks_order')
+    corner_order = order('corners_and_indirect_freekicks_order')
+
+    def flag(mask):
+        # Missing orders (NaN / pd.NA) never count
+        return mask.to_numpy(dtype=bool, na_value=False)
+
+    is_penalty = flag(pen_order == 1)
+    pen_backup = flag((pen_order != 1) & (pen_order <= 2))
+    is_free_kick = flag(fk_order == 1)
+    is_corner = flag(corner_order == 1)
+    corner_shared = flag((corner_order != 1) & (corner_order <= 2))
+
+    roles = SET_PIECE_ROLE_COMBOS[is_penalty * 4 + is_free_kick * 2 + is_corner * 1]
+
+    # Every note part carries its " | " separator; the trailing one is stripped after concatenation
+    notes = (
+        pd.Series(np.select([is_penalty, pen_backup], ["Primary Penalty Taker | ", "Backup Penalty Taker | "], default=""), index=df.index)
+        + np.where(is_free_kick, "Direct Free Kick Taker | ", "")
+        + np.select([is_corner, corner_shared], ["Primary Corner Taker | ", "Shared Corner Duties | "], default="")
+    ).str.removesuffix(" | ")
+    return pd.Series(roles, index=df.index, dtype=object), notes, is_penalty, is_free_kick, is_corner
+
+# --- NEW: Long-format History Analytics ---
+# All fetched histories in one columnar table (player, round, points, minutes, was_home);
+# form, trend, variance and venue splits are grouped operations over it instead of per-player loops.
+FORM_WINDOW = 5          # most recent matches used for weighted form / avg minutes / variance
+TREND_RECENT = 2         # newest matches compared against the rest of the window
+TREND_THRESHOLD = 1.5    # points per match difference that counts as a trend
+HISTORY_COLUMNS = ['player', 'round', 'points', 'minutes', 'was_home']
+
+def build_history_frame(histories: Dict[int, Dict]) -> pd.DataFrame:
+    """
+    Concatenates {player_id: {'history': [...]}} into one long table, newest match first per player.
+    Malformed records (missing or non-numeric round / total_points / minutes) are dropped row by row,
+    so one bad element-summary never fails the whole build.
+    """
+    players, rounds, points, minutes, was_home = [], [], [], [], []
+    for pid, data in histories.items():
+        history = data.get('history') if isinstance(data, dict) else None
+        for match in history if isinstance(history, list) else []:
+            if not isinstance(match, dict):
+                continue
+            players.append(pid)
+            rounds.append(match.get('round'))
+            points.append(match.get('total_points'))
+            minutes.append(match.get('minutes'))
+            was_home.append(bool(match.get('was_home', False)))
+    frame = pd.DataFrame({'player': players, 'round': rounds, 'points': points, 'minutes': minutes, 'was_home': was_home},
+                         columns=HISTORY_COLUMNS)
+    for col in ['player', 'round', 'points', 'minutes']:
+        frame[col] = pd.to_numeric(frame[col], errors='coerce')
+    frame = frame.dropna(subset=['player', 'round', 'points', 'minutes'])
+    frame = frame.astype({'player': int, 'round': int, 'points': int, 'minutes': int, 'was_home': bool})
+    # Stable sort: matches in the same round (DGW) keep their API order
+    return frame.sort_values(['player', 'round'], ascending=[True, False], kind='mergesort').reset_index(drop=True)
+
+def player_form_metrics(history: pd.DataFrame, window: int = FORM_WINDOW) -> pd.DataFrame:
+    """
+    Per-player weighted_form, form_trend, avg_minutes and points_variance over the last `window` matches.
+    Weights run window..1 from the newest match. Players without matches are absent from the result.
+    Expects build_history_frame ordering (grouped by player, newest first).
+    """
+    columns = ['weighted_form', 'form_trend', 'avg_minutes', 'points_variance']
+    if history.empty:
+        return pd.DataFrame(columns=columns)
+    codes, players = pd.factorize(history['player'])
+    counts = np.bincount(codes)
+    position = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Keep only the window; np.bincount sums in row order, matching the old per-player loops exactly
+    in_window = position < window
+    codes, position = codes[in_window], position[in_window]
+    points = history['points'].to_numpy(dtype=float)[in_window]
+    minutes = history['minutes'].to_numpy(dtype=float)[in_window]
+    weight = (window - position).astype(float)
+    k = len(players)
+
+    n = np.bincount(codes, minlength=k)
+    weighted_form = np.bincount(codes, weights=points * weight, minlength=k) / np.bincount(codes, weights=weight, minlength=k)
+    avg_minutes = np.bincount(codes, weights=minutes, minlength=k) / n
+
+    # Form Trend: newest TREND_RECENT matches vs the rest of the window
+    is_newest = position < TREND_RECENT
+    newest_avg = np.bincount(codes, weights=np.where(is_newest, points, 0.0), minlength=k) / TREND_RECENT
+    older_avg = np.bincount(codes, weights=np.where(is_newest, 0.0, points), minlength=k) / np.maximum(1, n - TREND_RECENT)
+    trend = np.select([newest_avg > older_avg + TREND_THRESHOLD, newest_avg < older_avg - TREND_THRESHOLD], ["🔥", "📉"], default="➖")
+    trend = np.where(n >= TREND_RECENT, trend, "➖")
+
+    # Population variance (np.var) of the window's points
+    mean_points = np.bincount(codes, weights=points, minlength=k) / n
+    variance = np.bincount(codes, weights=(points - mean_points[codes]) ** 2, minlength=k) / n
+    variance = np.where(n > 1, variance, 0.0)
+
+    return pd.DataFrame({
+        'weighted_form': weighted_form,
+        'form_trend': pd.array(trend, dtype=object),
+        'avg_minutes': avg_minutes,
+        'points_variance': variance
+    }, index=pd.Index(players, name='player'), columns=columns)
+
+def home_away_splits(history: pd.DataFrame) -> pd.DataFrame:
+    """Per-player home_avg / away_avg points and home_games / away_games over the whole history."""
+    counts = history.pivot_table(index='player', columns='was_home', values='points', aggfunc='count', fill_value=0)
+    sums = history.pivot_table(index='player', columns='was_home', values='points', aggfunc='sum', fill_value=0)
+    counts = counts.reindex(columns=[True, False], fill_value=0)
+    sums = sums.reindex(columns=[True, False], fill_value=0)
+    return pd.DataFrame({
+        'home_avg': (sums[True] / counts[True].where(counts[True] > 0)).fillna(0.0),
+        'away_avg': (sums[False] / counts[False].where(counts[False] > 0)).fillna(0.0),
+        'home_games': counts[True].astype(int),
+        'away_games': counts[False].astype(int)
+    })
 
 def engineer_features_enhanced(elements: pd.DataFrame, teams: pd.DataFrame, nf: pd.DataFrame, understat_players: pd.DataFrame, my_team_ids: List[int] = None, gameweek: int = 1) -> pd.DataFrame:
     elements = elements.copy()
-    
-    # --- NEW: Parallel Weighted Form Calculation ---
-    # Fetch history and calculate weighted form for all players
-    # Use ThreadPoolExecutor for I/O bound tasks (API calls)
-    weighted_forms = {}
-    form_trends = {}
-    avg_minutes_map = {}
-    variance_map = {}
-    
-    # Limit to relevant players to save time (e.g., > 0.5% ownership or price > 4.0)
-    # Optimization: Only fetch for Top 250 owned + Top 100 points to reduce API calls (approx 300 unique)
-    # This prevents hundreds of concurrent requests for irrelevant players.
-    
-    # Ensure columns are numeric for sorting
+    if 'web_name_norm' not in elements.columns:
+        # Normally precomputed once per bootstrap by build_master_tables
+        add_normalized_names(elements)
+    
+    # --- NEW: Bulk Weighted Form Calculation ---
+    # Fetch history for the whole player pool in one async batch (no top-owned cutoff),
+    # so cheap enablers get a real avg_minutes instead of the season-average fallback.
+    # Ensure columns are numeric
     elements['selected_by_percent'] = pd.to_numeric(elements['selected_by_percent'], errors='coerce').fillna(0)
     elements['total_points'] = pd.to_numeric(elements['total_points'], errors='coerce').fillna(0)
     elements['minutes'] = pd.to_numeric(elements['minutes'], errors='coerce').fillna(0)
     
-    top_owned = elements.nlargest(250, 'selected_by_percent')['id'].tolist()
-    top_points = elements.nlargest(100, 'total_points')['id'].tolist()
-    
-    # Always include user's current team to ensure xMins is calculated for them
-    relevant_players = set(top_owned + top_points)
+    # my_team_ids is kept for callers; the user's squad is always part of the full pool
+    relevant_players = set(int(pid) for pid in elements['id'])
     if my_team_ids:
-        relevant_players.update(my_team_ids)
-    relevant_players = list(relevant_players)
+        relevant_players.update(int(pid) for pid in my_team_ids)
 
-    # Capture the current Streamlit context to pass to threads
-    try:
-        ctx = get_script_run_ctx()
-    except Exception:
-        ctx = None
-
-    def analyze_wrapper(pid):
-        # Attach the context to the worker thread
-        if ctx:
-            add_script_run_ctx(threading.current_thread(), ctx)
-        return analyze_player_history(pid)
-
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        future_to_id = {executor.submit(analyze_wrapper, pid): pid for pid in relevant_players}
-        for future in as_completed(future_to_id):
-            pid = future_to_id[future]
-            try:
-                res = future.result()
-                weighted_forms[pid] = res['weighted_form']
-                form_trends[pid] = res['form_trend']
-                avg_minutes_map[pid] = res['avg_minutes']
-                variance_map[pid] = res.get('points_variance', 0.0)
-            except Exception:
-                weighted_forms[pid] = 0.0
-                form_trends[pid] = "➖"
-                avg_minutes_map[pid] = 0.0
-                variance_map[pid] = 0.0
+    histories = get_player_histories(tuple(sorted(relevant_players)))
+    # Failed fetches / empty histories have no rows -> season-average fallbacks below
+    history = build_history_frame(histories)
+    form = player_form_metrics(history)
     
-    # Map calculated values. For those not in relevant_players, fallback to standard 'form'
-    elements['weighted_form'] = elements['id'].map(weighted_forms)
-    # Fallback: Use standard form for non-VIP players
+    # Map calculated values. For players without history, fallback to standard 'form'
+    elements['weighted_form'] = elements['id'].map(form['weighted_form'])
+    # Fallback: Use standard form for players without history
     elements['weighted_form'] = elements['weighted_form'].fillna(pd.to_numeric(elements['form'], errors='coerce').fillna(0.0))
     
-    elements['form_trend'] = elements['id'].map(form_trends).fillna("➖")
+    elements['form_trend'] = elements['id'].map(form['form_trend']).fillna("➖")
     
     # Fallback for avg_minutes: Use 'minutes' / gameweek (approx) if not calculated
-    # This ensures players from smaller teams (not in top owned) still have an xMins value
-    def get_fallback_minutes(row):
-        if row['id'] in avg_minutes_map:
-            return avg_minutes_map[row['id']]
-        # Fallback: Season average
-        return row['minutes'] / max(1, gameweek)
+    # This ensures players whose history fetch failed still have an xMins value
+    has_history = elements['id'].isin(form.index)
+    elements['avg_minutes'] = np.where(
+        has_history,
+        elements['id'].map(form['avg_minutes']),
+        elements['minutes'] / max(1, gameweek) # Fallback: Season average
+    )
+    elements['points_variance'] = elements['id'].map(form['points_variance']).fillna(0.0)
 
-    elements['avg_minutes'] = elements.apply(get_fallback_minutes, axis=1)
-    elements['points_variance'] = elements['id'].map(variance_map).fillna(0.0)
+    # Home/Away split for every player (used by the player comparison)
+    splits = home_away_splits(history)
+    elements['home_avg'] = elements['id'].map(splits['home_avg']).fillna(0.0).round(2)
+    elements['away_avg'] = elements['id'].map(splits['away_avg']).fillna(0.0).round(2)
+    elements['home_games'] = elements['id'].map(splits['home_games']).fillna(0).astype(int)
+    elements['away_games'] = elements['id'].map(splits['away_games']).fillna(0).astype(int)
 
     elements["element_type"] = pd.to_numeric(elements["element_type"], errors='coerce').fillna(0).astype(int)
     elements = elements.merge(nf, on="team", how="left")
@@ -302,15 +471,12 @@ def engineer_features_enhanced(elements: pd.DataFrame, teams: pd.DataFrame, nf:
     elements["play_prob"] = elements["chance_of_playing_next_round"] / 100.0
 
     if not understat_players.empty and 'xG' in understat_players.columns:
-        # Normalize names for better matching
-        import unidecode
-        def normalize_name(n): return unidecode.unidecode(str(n)).lower().replace("-", " ").replace("'", "")
-
-        elements['web_name_norm'] = elements['web_name'].apply(normalize_name)
-        elements['full_name_norm'] = (elements['first_name'] + " " + elements['second_name']).apply(normalize_name)
-        understat_players['player_name_norm'] = understat_players['player_name'].apply(normalize_name)
-        
-        us_dedup = understat_players[['player_name_norm', 'xG', 'xA']].drop_duplicates('player_name_norm')
+        # Understat frame is shared (cached) -> build the key on a new frame instead of adding a column
+        us_dedup = pd.DataFrame({
+            'player_name_norm': understat_players['player_name'].map(normalize_name),
+            'xG': understat_players['xG'],
+            'xA': understat_players['xA']
+        }).drop_duplicates('player_name_norm')
         
         # Merge 1: Match on Web Name
         elements = elements.merge(us_dedup, left_on='web_name_norm', right_on='player_name_norm', how='left', suffixes=('', '_web'))
@@ -323,7 +489,7 @@ def engineer_features_enhanced(elements: pd.DataFrame, teams: pd.DataFrame, nf:
         elements['xA'] = elements['xA'].fillna(elements['xA_full']).fillna(0)
         
         # Cleanup
-        drop_cols = ['web_name_norm', 'full_name_norm', 'player_name_norm', 'player_name_norm_full', 'xG_full', 'xA_full']
+        drop_cols = ['player_name_norm', 'player_name_norm_full', 'xG_full', 'xA_full']
         elements.drop(columns=[c for c in drop_cols if c in elements.columns], inplace=True, errors='ignore')
     else:
         elements['xG'] = 0.0
@@ -346,129 +512,72 @@ def engineer_features_enhanced(elements: pd.DataFrame, teams: pd.DataFrame, nf:
     dynamic_penalty_takers = generate_penalty_takers_map(elements, teams)
 
     # --- UPGRADE: xMins Approximation ---
-    # xMins = min(90, avg_minutes * play_prob)
-    # --- UPGRADE: xMins Approximation ---
-    # xMins = min(90, avg_minutes * play_prob)
-    elements['xMins'] = elements.apply(lambda x: min(90, x['avg_minutes'] * x['play_prob']), axis=1)
+    # xMins = min(90, avg_minutes * play_prob)  (NaN -> 90, like the builtin min did)
+    raw_xmins = elements['avg_minutes'] * elements['play_prob']
+    elements['xMins'] = np.where(raw_xmins < 90, raw_xmins, 90.0)
 
     # --- NEW: Midweek Rotation Analysis ---
-    # Fetch midweek data for all relevant teams
-    midweek_cache = {}
-    unique_teams = elements['team'].unique()
-    
-    # for t_id in unique_teams:
-    #     midweek_cache[t_id] = get_midweek_data(t_id)
-        
-    def apply_midweek_rotation(row):
-        current_xmins = row['xMins']
-        team_id = row['team']
-        mw_data = midweek_cache.get(team_id, {})
-        
-        if not mw_data:
-            return current_xmins
-            
-        hours_gap = mw_data.get('hours_gap', 999)
-        
-        # Only apply if gap is short (< 72 hours)
-        if hours_gap < 72:
-            player_minutes = mw_data.get('player_minutes', {})
-            
-            # Normalize names for matching
-            import unidecode
-            def norm(n): return unidecode.unidecode(str(n)).lower().strip()
-            
-            web_name = norm(row['web_name'])
-            full_name = norm(row['first_name'] + " " + row['second_name'])
-            
-            # Try to find match
-            mins_played = 0
-            found = False
-            
-            for k, v in player_minutes.items():
-                k_norm = norm(k)
-                # Check for partial matches
-                if web_name == k_norm or k_norm in full_name or full_name in k_norm:
-                    mins_played = v
-                    found = True
-                    break
-            
-            if found:
-                if mins_played > 60:
-                    # High fatigue risk -> Cap xMins at 60
-                    return min(current_xmins, 60.0)
-                elif mins_played == 0:
-                    # Rested -> Boost slightly (Fresh legs)
-                    return min(90.0, current_xmins * 1.1)
-                    
-        return current_xmins
-
-    elements['xMins'] = elements.apply(apply_midweek_rotation, axis=1)
+    # All clubs in one concurrent batch; finished-match lineups are cached permanently
+    midweek_cache = get_midweek_index(tuple(int(t) for t in elements['team'].unique()))
+    hours_gap = elements['team'].map({t_id: mw.get('hours_gap', 999) for t_id, mw in midweek_cache.items()}).fillna(999)
+    mins_played = midweek_minutes_played(elements, midweek_cache)
+
+    # Only apply if gap is short (< 72 hours); players not found in the lineup keep their xMins
+    short_gap = hours_gap < 72
+    elements['xMins'] = np.select(
+        [short_gap & (mins_played > 60), short_gap & (mins_played == 0)],
+        [
+            np.minimum(elements['xMins'], 60.0),       # High fatigue risk -> Cap xMins at 60
+            np.minimum(90.0, elements['xMins'] * 1.1)  # Rested -> Boost slightly (Fresh legs)
+        ],
+        default=elements['xMins']
+    )
     
     # --- NEW: Set Piece Intelligence v2 ---
-    # Apply analyze_set_piece_role to each row
-    sp_analysis = elements.apply(analyze_set_piece_role, axis=1)
-    elements['set_piece_roles'] = sp_analysis.apply(lambda x: x[0])
-    elements['set_piece_note'] = sp_analysis.apply(lambda x: x[1])
+    elements['set_piece_roles'], elements['set_piece_note'], is_penalty, is_free_kick, is_corner = analyze_set_piece_roles(elements)
     
     # Calculate Aerial Threat Score
     # Threat per 90 > 20 for Defenders/Mids is good
     # Element Type: 1=GKP, 2=DEF, 3=MID, 4=FWD
-    def get_aerial_threat(row):
-        threat_per_90 = (row['threat'] / row['minutes']) * 90 if row['minutes'] > 0 else 0
-        if row['element_type'] == 2 and threat_per_90 > 15: # Defender with high threat
-            return 1
-        if row['element_type'] == 3 and threat_per_90 > 25: # Midfielder (e.g. Soucek)
-            return 1
-        if row['element_type'] == 4 and threat_per_90 > 40: # Target Man
-            return 1
-        return 0
-        
-    elements['is_aerial_threat'] = elements.apply(get_aerial_threat, axis=1)
+    minutes = elements['minutes']
+    threat_per_90 = np.where(minutes > 0, elements['threat'] / minutes.where(minutes > 0) * 90, 0)
+    element_type = elements['element_type']
+    elements['is_aerial_threat'] = (
+        ((element_type == 2) & (threat_per_90 > 15)) |  # Defender with high threat
+        ((element_type == 3) & (threat_per_90 > 25)) |  # Midfielder (e.g. Soucek)
+        ((element_type == 4) & (threat_per_90 > 40))    # Target Man
+    ).astype(int)
     
     # --- Dynamic Prediction Calculation ---
-    def calculate_dynamic_pred(row):
-        score = 0.0
-        
-        # 1. Base Points (from API)
-        # Use base_xP calculated earlier
-        base_score = float(row.get('base_xP', 0)) * pos_mult[int(row['element_type'])-1]
-        
-        # 2. Fixture Difficulty Adjustment
-        pos = row.get('element_type', 3)
-        if pos in [1, 2]: # GK, DEF -> Want weak Opponent Attack
-            fix_ease = row.get('fixture_ease_def', row.get('avg_fixture_ease', 0))
-        else: # MID, FWD -> Want weak Opponent Defense
-            fix_ease = row.get('fixture_ease_att', row.get('avg_fixture_ease', 0))
-            
-        if fix_ease > 4: base_score *= 1.1
-        elif fix_ease < 2: base_score *= 0.9
-            
-        # 3. Set Piece Bonus (Dynamic Version)
-        sp_bonus = 0.0
-        roles = row.get('set_piece_roles', [])
-        if 'Penalty' in roles: sp_bonus += 1.0
-        if 'Free Kick' in roles: sp_bonus += 0.4
-        if 'Corner' in roles: sp_bonus += 0.3
-        
-        # Aerial Threat Bonus
-        if row.get('is_aerial_threat', 0): sp_bonus += 0.2
-        
-        # 4. Apply xMins scaling to the total potential
-        # (Base + SP Bonus) * Availability
-        final_pred = (base_score + sp_bonus) * (row['xMins'] / 90.0)
-        
-        # 5. DGW/BGW
-        num_fix = row.get('num_fixtures', 1)
-        if num_fix == 2: final_pred *= 1.6 # DGW Bonus
-        elif num_fix == 0: final_pred = 0 # BGW
-        
-        # 6. Venue Adjustment (Home/Away)
-        venue_mult = float(row.get('venue_multiplier', 1.0))
-        final_pred *= venue_mult
-        
-        return final_pred
-
-    elements['pred_points'] = elements.apply(calculate_dynamic_pred, axis=1)
+    # 1. Base Points (from API)
+    # NB: indexes pos_mult by element_type position, exactly as the per-row version did
+    base_score = elements['base_xP'].astype(float) * pos_mult[element_type.values - 1]
+
+    # 2. Fixture Difficulty Adjustment
+    # GK, DEF -> Want weak Opponent Attack; MID, FWD -> Want weak Opponent Defense
+    fallback_ease = elements['avg_fixture_ease'] if 'avg_fixture_ease' in elements.columns else 0
+    ease_def = elements['fixture_ease_def'] if 'fixture_ease_def' in elements.columns else fallback_ease
+    ease_att = elements['fixture_ease_att'] if 'fixture_ease_att' in elements.columns else fallback_ease
+    fix_ease = np.where(element_type.isin([1, 2]), ease_def, ease_att)
+    base_score = base_score * np.select([fix_ease > 4, fix_ease < 2], [1.1, 0.9], default=1.0)
+
+    # 3. Set Piece Bonus (Dynamic Version) + Aerial Threat Bonus
+    sp_bonus = np.zeros(len(elements))
+    sp_bonus = sp_bonus + np.where(is_penalty, 1.0, 0.0)
+    sp_bonus = sp_bonus + np.where(is_free_kick, 0.4, 0.0)
+    sp_bonus = sp_bonus + np.where(is_corner, 0.3, 0.0)
+    sp_bonus = sp_bonus + np.where(elements['is_aerial_threat'] != 0, 0.2, 0.0)
+
+    # 4. Apply xMins scaling to the total potential: (Base + SP Bonus) * Availability
+    final_pred = (base_score + sp_bonus) * (elements['xMins'] / 90.0)
+
+    # 5. DGW/BGW
+    num_fix = elements['num_fixtures']
+    final_pred = np.where(num_fix == 0, 0.0, final_pred * np.where(num_fix == 2, 1.6, 1.0))
+
+    # 6. Venue Adjustment (Home/Away); blank teams have no venue_multiplier -> NaN, as before
+    venue_mult = elements['venue_multiplier'].astype(float) if 'venue_multiplier' in elements.columns else 1.0
+    elements['pred_points'] = final_pred * venue_mult
     
     # --- NEW: Ceiling/Floor Projection ---
     # Calculate Standard Deviation from Variance
@@ -478,19 +587,117 @@ def engineer_features_enhanced(elements: pd.DataFrame, teams: pd.DataFrame, nf:
     elements['floor'] = elements['pred_points'] - elements['points_sd']
     elements['ceiling'] = elements['pred_points'] + elements['points_sd']
     
-    # Ensure non-negative floor
-    elements['floor'] = elements['floor'].apply(lambda x: max(0, x))
+    # Ensure non-negative floor (NaN -> 0, like max(0, x) did)
+    elements['floor'] = np.where(elements['floor'] > 0, elements['floor'], 0.0)
     
     # Determine Risk Level
-    def get_risk_level(sd):
-        if sd < 2.0: return "LOW"
-        elif sd < 4.0: return "MEDIUM"
-        else: return "HIGH"
-        
-    elements['risk_level'] = elements['points_sd'].apply(get_risk_level)
-    elements['selection_score'] = elements.apply(calculate_smart_selection_score, axis=1)
+    sd = elements['points_sd']
+    elements['risk_level'] = np.select([sd < 2.0, sd < 4.0], ["LOW", "MEDIUM"], default="HIGH")
+    elements['selection_score'] = calculate_smart_selection_scores(elements)
+
+    # Name keys were only needed by the matchers above
+    return elements.drop(columns=NAME_KEY_COLUMNS)
+
+def build_snapshot_master_tables(snapshot: Dict) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """build_master_tables for a shared data snapshot ('stats' dropped so fixtures stay hashable for st.cache_data)."""
+    elements, teams, events, fixtures_df = build_master_tables(snapshot['bootstrap'], snapshot['fixtures'])
+    if 'stats' in fixtures_df.columns:
+        fixtures_df = fixtures_df.drop(columns=['stats'])
+    return elements, teams, events, fixtures_df
 
-    return elements
+# --- NEW: Versioned Feature Store ---
+# One feature table per (snapshot version, Understat fingerprint), shared by all sessions.
+# The snapshot worker builds it before a swap. When a session needs players whose history fetch
+# failed (season-average fallback), only then are histories retried; if any now succeed the whole
+# table is rebuilt (synchronously, from the history store) and replaces the shared entry.
+FEATURE_STORE_SIZE = 2
+FEATURE_RETRY_AFTER = 60
+
+_feature_store = {}
+_feature_lock = threading.Lock()
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """Content hash of a DataFrame (values, index and column names)."""
+    if df is None or df.empty:
+        return "empty"
+    hashed = pd.util.hash_pandas_object(df, index=True).values
+    return hashlib.sha1(hashed.tobytes() + "|".join(map(str, df.columns)).encode("utf-8")).hexdigest()[:16]
+
+def _store_features(key: Tuple[str, str], entry: Dict):
+    with _feature_lock:
+        _feature_store.pop(key, None)
+        _feature_store[key] = entry
+        while len(_feature_store) > FEATURE_STORE_SIZE:
+            _feature_store.pop(next(iter(_feature_store)))
+
+def _build_feature_entry(snapshot: Dict, us_players: pd.DataFrame) -> Dict:
+    elements, teams, events, fixtures_df = get_snapshot_derived(snapshot, 'master_tables')
+    cur_event, next_event = current_and_next_event(snapshot['bootstrap'].get("events", []))
+    target_event = next_event or (cur_event + 1 if cur_event else 1)
+
+    nf = next_fixture_features(fixtures_df, teams, target_event)
+    feat = engineer_features_enhanced(elements, teams, nf, us_players, my_team_ids=None, gameweek=cur_event or 1)
+    feat.set_index('id', inplace=True)
+    fallback_ids = frozenset(missing_player_histories(feat.index))
+    return {
+        'cur_event': cur_event, 'target_event': target_event, 'nf': nf, 'feat': feat,
+        'fallback_ids': fallback_ids,
+        'retry_at': time.time() + FEATURE_RETRY_AFTER,
+        # Rebuilds only happen when fallbacks shrink, so the count tells the builds of one snapshot apart
+        'version': f"{snapshot['version']}-{frame_fingerprint(us_players)}-{len(fallback_ids)}"
+    }
+
+def _extend_feature_entry(key: Tuple[str, str], snapshot: Dict, us_players: pd.DataFrame, player_ids: frozenset) -> Dict:
+    entry = _feature_store.get(key)
+    if entry is None:
+        # Evicted since the caller looked it up -> a fresh build already retries what it can
+        entry = _build_feature_entry(snapshot, us_players)
+        _store_features(key, entry)
+        return entry
+    retry = entry['fallback_ids'] & player_ids
+    if not retry or time.time() < entry['retry_at']:
+        return entry # another session just did it
+    if len(missing_player_histories(retry)) == len(retry):
+        get_player_histories(tuple(sorted(retry))) # retries just these players
+    if len(missing_player_histories(retry)) < len(retry):
+        entry = _build_feature_entry(snapshot, us_players) # history store now has them
+    else:
+        entry = dict(entry, retry_at=time.time() + FEATURE_RETRY_AFTER)
+    _store_features(key, entry)
+    return entry
+
+def get_feature_table(snapshot: Dict, my_team_ids: Optional[List[int]] = None) -> Dict:
+    """
+    Feature table for a data snapshot and the current Understat data:
+    {'cur_event', 'target_event', 'nf', 'feat' (indexed by player id), 'fallback_ids', 'retry_at', 'version'}.
+    my_team_ids: players that should have real history; fallback ones are retried (at most every FEATURE_RETRY_AFTER s).
+    The table is shared between sessions -> copy before mutating.
+    """
+    us_players, _ = get_understat_data()
+    key = (snapshot['version'], frame_fingerprint(us_players))
+    entry = _feature_store.get(key)
+    if entry is None:
+        def build():
+            built = _feature_store.get(key)
+            if built is None:
+                built = _build_feature_entry(snapshot, us_players)
+                _store_features(key, built)
+            return built
+        entry = single_flight(('features',) + key, build)
+
+    if my_team_ids:
+        wanted = frozenset(int(pid) for pid in my_team_ids)
+        if entry['fallback_ids'] & wanted and time.time() >= entry['retry_at']:
+            entry = single_flight(('features-extend',) + key, lambda: _extend_feature_entry(key, snapshot, us_players, wanted))
+    return entry
+
+def build_snapshot_features(snapshot: Dict) -> Dict:
+    """Warms the feature store for a new snapshot (runs in the snapshot worker before the swap)."""
+    return get_feature_table(snapshot)
+
+register_snapshot_derivation('master_tables', build_snapshot_master_tables)
+register_snapshot_derivation('fixture_index', build_snapshot_fixture_index)
+register_snapshot_derivation('features', build_snapshot_features)
 
 def smart_bench_order(bench_df: pd.DataFrame) -> pd.DataFrame:
     bench_gk = bench_df[bench_df['element_type'] == 1]
@@ -618,62 +825,69 @@ def analyze_lineup_insights(xi_df: pd.DataFrame, bench_df: pd.DataFrame) -> List
     
     return insights
 
-@st.cache_data(ttl=300)
-def get_fixture_difficulty_matrix(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, lookahead: int = 5):
-    team_names = teams_df.set_index('id')['short_name'].to_dict()
-    team_strength = teams_df.set_index('id')
-    future_gws = list(range(current_event, min(current_event + lookahead, 39)))
-    future_fixtures = fixtures_df[fixtures_df['event'].isin(future_gws)]
-    
-    opp_data = {team_id: {} for team_id in teams_df['id']}
-    diff_data = {team_id: {} for team_id in teams_df['id']}
+# --- NEW: Fixture Difficulty Matrix (pivot-based) ---
+# Built from the fixture index with one groupby/unstack per matrix; cached (at most DIFFICULTY_CACHE_SIZE
+# entries) per (snapshot version, current_event, lookahead). Callers without a snapshot version fall back
+# to a fixtures/teams content fingerprint, which costs a hash of both frames per call.
+DIFFICULTY_CACHE_SIZE = 8
 
-    for gw in future_gws:
-        gw_fixtures = future_fixtures[future_fixtures['event'] == gw]
-        teams_with_fixtures = set(gw_fixtures['team_h']).union(set(gw_fixtures['team_a']))
-
-        for team_id in teams_df['id']:
-            if team_id not in teams_with_fixtures:
-                opp_data[team_id][f'GW{gw}'] = "BLANK"
-                diff_data[team_id][f'GW{gw}'] = 0
-                continue
+_difficulty_cache = {}
+_difficulty_lock = threading.Lock()
 
-            home_games = gw_fixtures[gw_fixtures['team_h'] == team_id]
-            away_games = gw_fixtures[gw_fixtures['team_a'] == team_id]
-            opponents, difficulties = [], []
-            
-            for _, game in home_games.iterrows():
-                opp_id = game['team_a']
-                opp_rank = team_strength.loc[opp_id, 'position']
-                opponents.append(f"{team_names.get(opp_id, '?')} (H) (อันดับ {opp_rank})")
-                difficulties.append(opp_rank)
-
-            for _, game in away_games.iterrows():
-                opp_id = game['team_h']
-                opp_rank = team_strength.loc[opp_id, 'position']
-                opponents.append(f"{team_names.get(opp_id, '?')} (A) (อันดับ {opp_rank})")
-                difficulties.append(opp_rank)
-            
-            opp_data[team_id][f'GW{gw}'] = ", ".join(opponents)
-            diff_data[team_id][f'GW{gw}'] = np.mean(difficulties) if difficulties else 0
+def build_fixture_difficulty_matrix(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, lookahead: int = 5) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    (opp_df, diff_df): team short name × 'GW<n>' opponent labels ("BLANK" if no game) and average
+    opponent league position (0 if no game) + 'Total', sorted by Total (higher = easier run).
+    """
+    team_ids = teams_df['id'].to_numpy()
+    team_names = teams_df.set_index('id')['short_name']
+    future_gws = list(range(current_event, min(current_event + lookahead, 39)))
+    gw_cols = [f'GW{gw}' for gw in future_gws]
+
+    rows = fixture_rows(get_fixture_index(fixtures_df, teams_df), future_gws)
+    opp_rank = rows['opponent'].map(teams_df.set_index('id')['position'])
+    labels = (rows['opponent'].map(team_names).fillna('?').astype(str)
+              + np.where(rows['is_home'], ' (H) (อันดับ ', ' (A) (อันดับ ') + opp_rank.astype(str) + ')')
+    games = pd.DataFrame({'team': rows['team'], 'event': rows['event'], 'label': labels, 'rank': opp_rank})
+    grouped = games.groupby(['team', 'event'], sort=False)
+
+    # Labels keep index order inside a (team, GW): home games first, then fixture order
+    opp_df = grouped['label'].agg(', '.join).unstack('event').reindex(index=team_ids, columns=future_gws).fillna("BLANK")
+    diff_df = grouped['rank'].mean().unstack('event').reindex(index=team_ids, columns=future_gws).fillna(0).astype(float)
+    opp_df = opp_df.astype(str)
+    opp_df.columns, diff_df.columns = gw_cols, gw_cols
+    opp_df.columns.name = diff_df.columns.name = opp_df.index.name = diff_df.index.name = None
 
-    opp_df = pd.DataFrame(opp_data).T
-    diff_df = pd.DataFrame(diff_data).T.fillna(0)
     opp_df.index = opp_df.index.map(team_names)
     diff_df.index = diff_df.index.map(team_names)
-    diff_df['Total'] = diff_df.sum(axis=1)
+    # Row-contiguous sum: same addition order as the dict-built frame had (keeps Total ties/sorting stable)
+    diff_df['Total'] = np.ascontiguousarray(diff_df[gw_cols].to_numpy()).sum(axis=1)
     diff_df = diff_df.sort_values('Total', ascending=False)
     opp_df = opp_df.loc[diff_df.index]
 
     return opp_df, diff_df
 
-def detect_fixture_swing(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int) -> Dict[int, Dict]:
+def get_fixture_difficulty_matrix(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, lookahead: int = 5, snapshot_version: Optional[str] = None):
+    """Cached build_fixture_difficulty_matrix (copies). Pass the data snapshot's version to skip content hashing."""
+    data_key = ('snapshot', snapshot_version) if snapshot_version else _fixture_key(fixtures_df, teams_df)
+    key = data_key + (current_event, lookahead)
+    matrices = _difficulty_cache.get(key)
+    if matrices is None:
+        matrices = build_fixture_difficulty_matrix(fixtures_df, teams_df, current_event, lookahead)
+        with _difficulty_lock:
+            _difficulty_cache[key] = matrices
+            while len(_difficulty_cache) > DIFFICULTY_CACHE_SIZE:
+                _difficulty_cache.pop(next(iter(_difficulty_cache)))
+    opp_df, diff_df = matrices
+    return opp_df.copy(), diff_df.copy()
+
+def detect_fixture_swing(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, snapshot_version: Optional[str] = None) -> Dict[int, Dict]:
     """
     Detects teams with significant fixture difficulty swings (Improving/Worsening).
     Compare Avg Difficulty of Next 3 GWs vs Following 3 GWs.
     """
     # Get matrix for next 6 GWs
-    _, diff_matrix = get_fixture_difficulty_matrix(fixtures_df, teams_df, current_event, lookahead=6)
+    _, diff_matrix = get_fixture_difficulty_matrix(fixtures_df, teams_df, current_event, lookahead=6, snapshot_version=snapshot_version)
     
     swing_data = {}
     team_map = teams_df.set_index('short_name')['id'].to_dict()
@@ -776,249 +990,535 @@ def find_rotation_pairs(difficulty_matrix: pd.DataFrame, teams_df: pd.DataFrame,
     pairs_df['Total Cost'] = pairs_df['Total Cost'].apply(lambda x: f"£{x:.1f}m")
     return pairs_df[['GK1', 'GK2', 'Total Cost','Rating']].head(10).reset_index(drop=True)
 
-@st.cache_data(ttl=300)
+# --- NEW: Player × GW Projection Matrix ---
+# Fixture multipliers are computed once per (team, GW) and broadcast over players, so ROI and
+# transfer search read slices of one players × GWs matrix instead of rescanning fixtures_df
+# for every candidate pair. Matrices are cached per content fingerprint (= data version).
+PROJECTION_CACHE_SIZE = 8
+PROJECTION_COLUMNS = ['team', 'base_xP', 'pred_points', 'avg_fixture_ease', 'play_prob']
+
+_projection_cache = {}
+_projection_lock = threading.Lock()
+
+def _cached_projection(key: Tuple, build):
+    entry = _projection_cache.get(key)
+    if entry is None:
+        entry = build()
+        with _projection_lock:
+            _projection_cache[key] = entry
+            while len(_projection_cache) > PROJECTION_CACHE_SIZE:
+                _projection_cache.pop(next(iter(_projection_cache)))
+    return entry
+
+def _team_grid(rows: pd.DataFrame, values: np.ndarray, teams_df: pd.DataFrame, gws: List[int]) -> pd.DataFrame:
+    """Sums per-fixture values into a team id × GW frame (blank = 0, double = both fixtures)."""
+    grid = pd.DataFrame({'team': rows['team'], 'event': rows['event'], 'value': values})
+    grid = grid.groupby(['team', 'event'])['value'].sum().unstack('event')
+    return grid.reindex(index=teams_df['id'].to_numpy(), columns=gws).fillna(0.0)
+
+def team_fixture_multipliers(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, start_gw: int, n_gws: int) -> pd.DataFrame:
+    """
+    team id × GW multiplier of predict_next_n_gws: league-average defence / opponent defence,
+    ×1.1 at home and ×0.9 away.
+    """
+    gws = list(range(start_gw, start_gw + n_gws))
+    def_strength = teams_df.set_index('id')['strength_defence_overall']
+    avg_def_strength = np.mean(def_strength.to_numpy())
+    rows = fixture_rows(get_fixture_index(fixtures_df, teams_df), gws)
+    opp_strength = rows['opponent'].map(def_strength).fillna(avg_def_strength).to_numpy(dtype=float)
+    multiplier = avg_def_strength / np.maximum(opp_strength, 1) * np.where(rows['is_home'], 1.1, 0.9)
+    return _team_grid(rows, multiplier, teams_df, gws)
+
+def team_roi_multipliers(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, start_gw: int, n_gws: int) -> pd.DataFrame:
+    """
+    team id × GW multiplier of calculate_3gw_roi: (1 + 1 - opponent strength / strongest home side),
+    ×1.1 at home and ×0.9 away. NaN when an opponent is not in teams_df.
+    """
+    gws = list(range(start_gw, start_gw + n_gws))
+    teams_idx = teams_df.set_index('id')
+    rows = fixture_rows(get_fixture_index(fixtures_df, teams_df), gws)
+    # Opponent plays away when we are at home, and vice versa
+    opp_str = np.where(rows['is_home'], rows['opponent'].map(teams_idx['strength_overall_away']),
+                       rows['opponent'].map(teams_idx['strength_overall_home'])).astype(float)
+    fixture_diff = 1.0 - (opp_str / teams_df['strength_overall_home'].max())
+    multiplier = np.where(rows['is_home'], 1.1, 0.9) * (1.0 + fixture_diff)
+    grid = _team_grid(rows, multiplier, teams_df, gws)
+    missing = rows.loc[np.isnan(multiplier), 'team'].unique()
+    grid.loc[grid.index.isin(missing)] = np.nan
+    return grid
+
+def _base_expected_points(players: pd.DataFrame) -> pd.Series:
+    if 'base_xP' in players.columns:
+        return players['base_xP'].astype(float)
+    ease = players['avg_fixture_ease'] if 'avg_fixture_ease' in players.columns else 1
+    return players['pred_points'].astype(float) / np.maximum(0.5, ease)
+
+def projection_matrix(players: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, start_gw: int, n_gws: int) -> pd.DataFrame:
+    """
+    Expected points per player (rows, same index as `players`) per GW start_gw..start_gw+n_gws-1 (columns):
+    base_xP × play_prob × that GW's team fixture multiplier.
+    """
+    multipliers = team_fixture_multipliers(fixtures_df, teams_df, start_gw, n_gws)
+    play_prob = players['play_prob'].astype(float) if 'play_prob' in players.columns else 1.0
+    scale = (_base_expected_points(players) * play_prob).to_numpy()
+    team_mult = multipliers.reindex(players['team'].to_numpy()).fillna(0.0).to_numpy()
+    return pd.DataFrame(scale[:, None] * team_mult, index=players.index, columns=multipliers.columns)
+
+def get_projection_matrix(players: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, start_gw: int, n_gws: int) -> pd.DataFrame:
+    """Cached projection_matrix (shared between sessions -> do not mutate)."""
+    cols = [c for c in PROJECTION_COLUMNS if c in players.columns]
+    key = ('players', frame_fingerprint(players[cols])) + _fixture_key(fixtures_df, teams_df) + (start_gw, n_gws)
+    return _cached_projection(key, lambda: projection_matrix(players, fixtures_df, teams_df, start_gw, n_gws))
+
 def predict_next_n_gws(player_data: Dict, n_gws: int, current_gw: int, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> float:
-    # Use dictionary access instead of DataFrame lookup
     team_id = player_data['team']
     base_xp = player_data.get('base_xP', player_data.get('pred_points', 0) / max(0.5, player_data.get('avg_fixture_ease', 1)))
     play_prob = player_data.get('play_prob', 1.0)
-    
-    total_expected_points = 0.0
-    team_def_strength = teams_df.set_index('id')['strength_defence_overall'].to_dict()
-    avg_def_strength = np.mean(list(team_def_strength.values()))
-
-    for gw in range(current_gw, current_gw + n_gws):
-        gw_fixtures = fixtures_df[(fixtures_df['event'] == gw) & ((fixtures_df['team_h'] == team_id) | (fixtures_df['team_a'] == team_id))]
-        if gw_fixtures.empty: continue
-        for _, fixture in gw_fixtures.iterrows():
-            is_home = fixture['team_h'] == team_id
-            opponent_id = fixture['team_a'] if is_home else fixture['team_h']
-            opp_strength = team_def_strength.get(opponent_id, avg_def_strength)
-            fixture_multiplier = avg_def_strength / max(opp_strength, 1)
-            home_boost = 1.1 if is_home else 0.9
-            total_expected_points += base_xp * fixture_multiplier * home_boost * play_prob
-    return total_expected_points
-
-def calculate_transfer_roi(player_out_id: int, player_in_id: int, current_gw: int, elements_df: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, hit_cost: int = 0, lookahead: int = 3) -> Dict:
-    # Extract necessary data to pass to cached function (avoids hashing full DataFrame)
-    cols = ['team', 'base_xP', 'pred_points', 'avg_fixture_ease', 'play_prob']
-    
-    p_out = elements_df.loc[player_out_id, cols].to_dict()
-    p_in = elements_df.loc[player_in_id, cols].to_dict()
-    
-    out_xp_3gw = predict_next_n_gws(p_out, lookahead, current_gw, fixtures_df, teams_df)
-    in_xp_3gw = predict_next_n_gws(p_in, lookahead, current_gw, fixtures_df, teams_df)
+
+    key = ('team-multipliers',) + _fixture_key(fixtures_df, teams_df) + (current_gw, n_gws)
+    multipliers = _cached_projection(key, lambda: team_fixture_multipliers(fixtures_df, teams_df, current_gw, n_gws))
+    if team_id not in multipliers.index:
+        return 0.0
+    return float(base_xp * play_prob * multipliers.loc[team_id].sum())
+
+def calculate_transfer_roi(player_out_id: int, player_in_id: int, current_gw: int, elements_df: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, hit_cost: int = 0, lookahead: int = 3, projections: Optional[pd.DataFrame] = None) -> Dict:
+    # projections: players × GWs matrix starting at current_gw (first `lookahead` columns are used)
+    if projections is None:
+        projections = get_projection_matrix(elements_df, fixtures_df, teams_df, current_gw, lookahead)
+    window = projections.columns[:lookahead]
+    out_xp_3gw = float(projections.loc[player_out_id, window].sum())
+    in_xp_3gw = float(projections.loc[player_in_id, window].sum())
     
     gross_gain = in_xp_3gw - out_xp_3gw
     net_gain = gross_gain - hit_cost
     return {"out_xp_3gw": out_xp_3gw, "in_xp_3gw": in_xp_3gw, "gross_gain": gross_gain, "net_gain": net_gain, "is_worth_it": net_gain > 0.5}
 
-def optimize_starting_xi(squad_players_df: pd.DataFrame) -> Tuple[List[int], List[int]]:
-    ids = list(squad_players_df.index)
-    positions = squad_players_df['element_type']
-    prob = LpProblem("XI_Optimization", LpMaximize)
-    x = {i: LpVariable(f"x_{i}", cat=LpBinary) for i in ids}
-    
-    objective_scores = squad_players_df['selection_score'] if 'selection_score' in squad_players_df.columns else squad_players_df['pred_points'] * squad_players_df['play_prob']
-    prob += lpSum([objective_scores.get(i, 0) * x[i] for i in ids])
-
-    prob += lpSum([x[i] for i in ids]) == 11
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 1]) == 1
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 2]) >= 3
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 2]) <= 5
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 3]) >= 2
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 3]) <= 5
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 4]) >= 1
-    prob += lpSum([x[i] for i in ids if positions.get(i) == 4]) <= 3
+# --- NEW: Closed-form Starting XI ---
+# 1 GK + 10 outfielders within the position limits leaves only 8 formations, so the best XI is
+# the best of "top-k per position" over those formations -- exact, in-process, no CBC.
+XI_POSITION_LIMITS = {1: (1, 1), 2: (3, 5), 3: (2, 5), 4: (1, 3)}
+XI_FORMATIONS = np.array([
+    (gk, d, m, f)
+    for gk in range(XI_POSITION_LIMITS[1][0], XI_POSITION_LIMITS[1][1] + 1)
+    for d in range(XI_POSITION_LIMITS[2][0], XI_POSITION_LIMITS[2][1] + 1)
+    for m in range(XI_POSITION_LIMITS[3][0], XI_POSITION_LIMITS[3][1] + 1)
+    for f in range(XI_POSITION_LIMITS[4][0], XI_POSITION_LIMITS[4][1] + 1)
+    if gk + d + m + f == 11
+])
+
+def select_starting_xi(scores: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Batch XI selection. scores / positions: (n_squads, n_players) arrays (position 0 = padding).
+    Returns a boolean (n_squads, n_players) mask of starters; all False where no formation fits.
+    Ties go to the earlier player (column order).
+    """
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    scores = np.where(np.isnan(scores), 0.0, scores)
+    positions = np.atleast_2d(positions)
+    n_players = scores.shape[1]
+    if n_players < 11: # pad so every formation's prefix index exists
+        scores = np.pad(scores, ((0, 0), (0, 11 - n_players)), constant_values=-np.inf)
+        positions = np.pad(positions, ((0, 0), (0, 11 - n_players)))
+    rows = np.arange(len(scores))[:, None]
+    best_totals = np.zeros((len(scores), len(XI_FORMATIONS)))
+    ranks = np.zeros(scores.shape, dtype=int)
+
+    for p in range(1, 5):
+        pos_scores = np.where(positions == p, scores, -np.inf)
+        order = np.argsort(-pos_scores, axis=1, kind='stable')
+        pos_ranks = np.empty_like(ranks)
+        pos_ranks[rows, order] = np.arange(scores.shape[1])
+        ranks = np.where(positions == p, pos_ranks, ranks)
+        # prefix[:, k] = sum of the k best in this position (-inf if fewer than k players)
+        prefix = np.concatenate([np.zeros((len(scores), 1)), np.cumsum(pos_scores[rows, order], axis=1)], axis=1)
+        best_totals += prefix[:, XI_FORMATIONS[:, p - 1]]
+
+    best = np.argmax(best_totals, axis=1)
+    feasible = np.isfinite(best_totals[np.arange(len(scores)), best])
+    quota = np.zeros_like(ranks)
+    for p in range(1, 5):
+        quota = np.where(positions == p, XI_FORMATIONS[best, p - 1][:, None], quota)
+    return ((ranks < quota) & feasible[:, None])[:, :n_players]
+
+def _xi_scores(squad_players_df: pd.DataFrame) -> pd.Series:
+    if 'selection_score' in squad_players_df.columns:
+        return squad_players_df['selection_score']
+    return squad_players_df['pred_points'] * squad_players_df['play_prob']
+
+def optimize_starting_xi_batch(squads: List[pd.DataFrame]) -> List[Tuple[List[int], List[int]]]:
+    """optimize_starting_xi for many squads in one vectorized pass."""
+    if not squads:
+        return []
+    width = max(len(squad) for squad in squads)
+    scores = np.full((len(squads), width), -np.inf)
+    positions = np.zeros((len(squads), width), dtype=int)
+    for row, squad in enumerate(squads):
+        scores[row, :len(squad)] = _xi_scores(squad).astype(float).to_numpy()
+        positions[row, :len(squad)] = squad['element_type'].to_numpy()
+
+    results = []
+    for squad, starters in zip(squads, select_starting_xi(scores, positions)):
+        ids = list(squad.index)
+        if not starters.any():
+            results.append(([], []))
+            continue
+        results.append(([i for i, start in zip(ids, starters) if start], [i for i, start in zip(ids, starters) if not start]))
+    return results
 
-    prob.solve(PULP_CBC_CMD(msg=0))
-    if LpStatus[prob.status] == 'Optimal':
-        start_ids = [i for i in ids if x[i].value() == 1]
-        bench_ids = [i for i in ids if i not in start_ids]
-        return start_ids, bench_ids
-    return [], []
+def optimize_starting_xi(squad_players_df: pd.DataFrame) -> Tuple[List[int], List[int]]:
+    return optimize_starting_xi_batch([squad_players_df])[0]
 
 def calculate_3gw_roi(player, fixtures_df, teams_df, current_event):
     try:
+        key = ('roi-multipliers',) + _fixture_key(fixtures_df, teams_df) + (current_event, 3)
+        multipliers = _cached_projection(key, lambda: team_roi_multipliers(fixtures_df, teams_df, current_event, 3))
         team_id = int(player['team'])
-        next_3gw = list(range(current_event, current_event + 3))
-        total_points = 0
-        for gw in next_3gw:
-            team_fixtures = fixtures_df[((fixtures_df['team_h'] == team_id) | (fixtures_df['team_a'] == team_id)) & (fixtures_df['event'] == gw)]
-            if team_fixtures.empty: continue
-            for _, fixture in team_fixtures.iterrows():
-                is_home = fixture['team_h'] == team_id
-                opp_team = fixture['team_a'] if is_home else fixture['team_h']
-                opp_str = teams_df.loc[teams_df['id'] == opp_team, 'strength_overall_away' if is_home else 'strength_overall_home'].iloc[0]
-                base_points = float(player.get('pred_points', 0)) / 2.0
-                max_str = teams_df['strength_overall_home'].max()
-                fixture_diff = 1.0 - (opp_str / max_str)
-                total_points += base_points * (1.1 if is_home else 0.9) * (1.0 + fixture_diff)
-        return total_points
+        if team_id not in multipliers.index:
+            return 0
+        team_mult = multipliers.loc[team_id]
+        if team_mult.isna().any():
+            raise KeyError(team_id) # opponent missing from teams_df
+        return float(player.get('pred_points', 0)) / 2.0 * team_mult.sum()
     except Exception:
         return float(player.get('pred_points', 0))
 
-def suggest_transfers(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, strategy: str, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, picks_data: List[Dict] = None) -> List[Dict]:
+# --- NEW: Multi-GW Transfer Planner (MILP) ---
+# One mixed-integer model over the next TRANSFER_PLAN_HORIZON GWs decides buys/sells, FT banking,
+# hits, the XI and the captain per GW (budget from real selling prices, 3-per-club, squad quotas).
+# CBC runs with a time limit; the best solution found by then is used.
+TRANSFER_PLAN_HORIZON = 3
+TRANSFER_PLAN_POOL = 20 # candidates per position by projected points (+ half as many by points per £)
+TRANSFER_PLAN_TIME_LIMIT = 10 # seconds
+TRANSFER_PENALTY = 0.01 # tie-breaker: no transfer without a real gain
+MAX_FREE_TRANSFERS = 5
+HIT_COST = 4
+PRICE_LOSS_PENALTY = 0.5 # same price-lock penalty as the greedy search (loss > £0.3m)
+
+def transfer_strategy_settings(strategy: str, free_transfers: int) -> Tuple[int, bool]:
+    """(max_transfers, allow_hits) for a transfer strategy name."""
+    if strategy == "Free Transfer":
+        return free_transfers, False
+    if strategy == "Allow Hit (AI Suggest)":
+        return 5, True
+    return 15, False
+
+def _sale_terms(player_id: int, now_cost: float, picks_data: Optional[List[Dict]]) -> Tuple[float, float]:
+    """(selling price in 0.1m, price loss in £m) for a squad player, from picks_data when available."""
+    pick = next((p for p in picks_data or [] if p['element'] == player_id), None)
+    if not pick or not pick.get('purchase_price'):
+        return now_cost, 0.0
+    selling_price = pick.get('selling_price', now_cost)
+    return selling_price, max(0.0, (pick['purchase_price'] - selling_price) / 10.0)
+
+def _plan_pool(squad: List[int], all_players: pd.DataFrame, horizon_xp: pd.Series) -> List[int]:
+    eligible = all_players[~all_players.index.isin(squad) & (all_players['chance_of_playing_next_round'] > 75)]
+    pool = set(squad)
+    for _, group in eligible.groupby('element_type'):
+        xp = horizon_xp.reindex(group.index).fillna(0)
+        pool.update(xp.nlargest(TRANSFER_PLAN_POOL).index)
+        pool.update((xp / group['now_cost']).nlargest(TRANSFER_PLAN_POOL // 2).index)
+    return [pid for pid in all_players.index if pid in pool]
+
+def plan_transfers(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, horizon: int = TRANSFER_PLAN_HORIZON, picks_data: List[Dict] = None, allow_hits: bool = True, max_transfers: int = 5, projections: Optional[pd.DataFrame] = None, time_limit: float = TRANSFER_PLAN_TIME_LIMIT) -> Optional[Dict]:
+    """
+    Multi-GW transfer plan: {'status', 'objective', 'gws': [{'gw', 'moves', 'free_transfers', 'hits',
+    'bank', 'xi', 'captain', 'expected_points'}, ...]}. 'moves' use the suggest_transfers format.
+    max_transfers limits the first GW's moves; later GWs follow the free transfers banked by the plan.
+    None if the squad is incomplete or CBC finds no solution within time_limit.
+    """
+    squad = [pid for pid in current_squad_ids if pid in all_players.index]
+    squad_size = sum(SQUAD_QUOTAS.values())
+    if len(squad) != squad_size:
+        return None
+    if projections is None:
+        projections = get_projection_matrix(all_players, fixtures_df, teams_df, current_event, horizon)
+    horizon = min(horizon, projections.shape[1])
+    xp_all = projections.iloc[:, :horizon].fillna(0)
+
+    ids = _plan_pool(squad, all_players, xp_all.sum(axis=1))
+    players = all_players.loc[ids]
+    xp = xp_all.reindex(ids).fillna(0).to_numpy()
+    positions = players['element_type'].to_numpy()
+    clubs = players['team'].to_numpy()
+    cost = players['now_cost'].astype(float).to_numpy()
+    owned = np.isin(ids, squad)
+    sale = {pid: _sale_terms(pid, players.at[pid, 'now_cost'], picks_data) for pid in squad}
+    sell_price = np.array([sale[pid][0] if pid in sale else c for pid, c in zip(ids, cost)], dtype=float)
+    loss_penalty = np.array([PRICE_LOSS_PENALTY if sale.get(pid, (0, 0.0))[1] > 0.3 else 0.0 for pid in ids])
+    P, T = range(len(ids)), range(horizon)
+
+    prob = LpProblem("Transfer_Plan", LpMaximize)
+    def binaries(name):
+        return [[LpVariable(f"{name}_{k}_{t}", cat=LpBinary) for t in T] for k in P]
+    in_squad, xi, cap, buy, sell = binaries("squad"), binaries("xi"), binaries("cap"), binaries("buy"), binaries("sell")
+    ft = [LpVariable(f"ft_{t}", 0, MAX_FREE_TRANSFERS, cat='Integer') for t in T]
+    used = [LpVariable(f"used_{t}", 0, cat='Integer') for t in T]
+    paid = [LpVariable(f"paid_{t}", 0, cat='Integer') for t in T]
+    takes_hit = [LpVariable(f"hit_{t}", cat=LpBinary) for t in T]
+    money = [LpVariable(f"bank_{t}", 0) for t in T]
+
+    prob += (lpSum(LpAffineExpression(zip([xi[k][t] for k in P] + [cap[k][t] for k in P], list(xp[:, t]) * 2)) for t in T)
+             - HIT_COST * lpSum(paid) - TRANSFER_PENALTY * lpSum(buy[k][t] for k in P for t in T)
+             - lpSum(loss_penalty[k] * sell[k][t] for k in P for t in T if loss_penalty[k]))
+
+    by_pos = {pos: np.flatnonzero(positions == pos) for pos in SQUAD_QUOTAS}
+    by_club = [np.flatnonzero(clubs == club) for club in np.unique(clubs)]
+    prob += ft[0] == min(max(free_transfers, 0), MAX_FREE_TRANSFERS)
+    for t in T:
+        for k in P:
+            before = in_squad[k][t - 1] if t else int(owned[k])
+            prob += in_squad[k][t] == before + buy[k][t] - sell[k][t]
+            prob += sell[k][t] <= before
+            prob += xi[k][t] <= in_squad[k][t]
+            prob += cap[k][t] <= xi[k][t]
+        for pos, quota in SQUAD_QUOTAS.items():
+            prob += lpSum(in_squad[k][t] for k in by_pos[pos]) == quota
+            low, high = XI_POSITION_LIMITS[pos]
+            prob += lpSum(xi[k][t] for k in by_pos[pos]) >= low
+            prob += lpSum(xi[k][t] for k in by_pos[pos]) <= high
+        for members in by_club:
+            prob += lpSum(in_squad[k][t] for k in members) <= SQUAD_CLUB_LIMIT
+        prob += lpSum(xi[k][t] for k in P) == 11
+        prob += lpSum(cap[k][t] for k in P) == 1
+
+        # Budget in 0.1m: sells at selling price, buys at now_cost
+        prob += money[t] == (money[t - 1] if t else round(bank * 10, 1)) + LpAffineExpression(
+            [(sell[k][t], sell_price[k]) for k in P] + [(buy[k][t], -cost[k]) for k in P])
+
+        # Free transfers are used before any hit; unused ones roll over (max MAX_FREE_TRANSFERS).
+        # max_transfers caps this GW only; later GWs are bounded by the banked ft[t] (and paid == 0 without hits)
+        n_transfers = lpSum(buy[k][t] for k in P)
+        if t == 0:
+            prob += n_transfers <= max_transfers
+        prob += used[t] <= ft[t]
+        prob += used[t] <= n_transfers
+        prob += paid[t] == n_transfers - used[t]
+        prob += paid[t] <= squad_size * takes_hit[t]
+        prob += used[t] >= ft[t] - MAX_FREE_TRANSFERS * (1 - takes_hit[t])
+        if not allow_hits:
+            prob += paid[t] == 0
+        if t + 1 < horizon:
+            prob += ft[t + 1] <= ft[t] - used[t] + 1
+
+    prob.solve(PULP_CBC_CMD(msg=0, timeLimit=time_limit))
+    if prob.sol_status not in (LpSolutionOptimal, LpSolutionIntegerFeasible):
+        return None
+
+    chosen = lambda x, t: [ids[k] for k in P if x[k][t].value() > 0.5]
+    roi_xp = projections.reindex(ids).fillna(0) # may extend past the horizon for 3-GW ROI
+    gws = []
+    for t in T:
+        outs, ins = chosen(sell, t), chosen(buy, t)
+        hits = int(round(paid[t].value()))
+        moves = []
+        for pos in SQUAD_QUOTAS:
+            # The model only fixes the sets; within a position pair the dearest out with the dearest in, and so on
+            pos_outs = sorted((pid for pid in outs if all_players.at[pid, 'element_type'] == pos),
+                              key=lambda pid: -sale.get(pid, (all_players.at[pid, 'now_cost'], 0.0))[0])
+            pos_ins = sorted((pid for pid in ins if all_players.at[pid, 'element_type'] == pos),
+                             key=lambda pid: -all_players.at[pid, 'now_cost'])
+            for out_id, in_id in zip(pos_outs, pos_ins):
+                selling_price, price_loss = sale.get(out_id, (all_players.at[out_id, 'now_cost'], 0.0))
+                gross_gain = float(roi_xp.loc[in_id].iloc[t:t + 3].sum() - roi_xp.loc[out_id].iloc[t:t + 3].sum())
+                penalty = PRICE_LOSS_PENALTY if price_loss > 0.3 else 0.0
+                moves.append({
+                    "out_id": out_id,
+                    "in_id": in_id,
+                    "out_name": all_players.at[out_id, 'web_name'],
+                    "out_cost": selling_price / 10.0,
+                    "in_name": all_players.at[in_id, 'web_name'],
+                    "in_cost": all_players.at[in_id, 'now_cost'] / 10.0,
+                    "delta_points": all_players.at[in_id, 'pred_points'] - all_players.at[out_id, 'pred_points'],
+                    "roi_3gw": gross_gain,
+                    "hit_cost": 0,
+                    "net_gain": gross_gain - penalty,
+                    "price_loss": price_loss,
+                    "warning": "⚠️ Selling at loss" if penalty else ""
+                })
+        # A GW's hits pay for its whole set of moves, so each move carries an equal share
+        for move in moves if hits else []:
+            move['hit_cost'] = hits * HIT_COST / len(moves)
+            move['net_gain'] -= move['hit_cost']
+        xi_ids = chosen(xi, t)
+        gws.append({
+            'gw': current_event + t,
+            'moves': moves,
+            'free_transfers': int(round(ft[t].value())),
+            'hits': hits,
+            'bank': round(money[t].value() / 10.0, 1),
+            'xi': xi_ids,
+            'captain': chosen(cap, t)[0],
+            'expected_points': float(sum(xp[ids.index(pid), t] for pid in xi_ids) + xp[ids.index(chosen(cap, t)[0]), t])
+        })
+    return {'status': LpSolution[prob.sol_status], 'objective': prob.objective.value(), 'gws': gws}
+
+TRANSFER_PLAN_CACHE_SIZE = 32
+
+_plan_cache = {}
+_plan_lock = threading.Lock()
+
+def get_transfer_plan(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, strategy: str, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, picks_data: List[Dict] = None, data_version: Optional[str] = None, horizon: int = TRANSFER_PLAN_HORIZON) -> Optional[Dict]:
+    """
+    plan_transfers for a transfer strategy, solved once per (data_version, squad, bank, FTs, strategy, selling
+    prices) and shared by suggest_transfers and plan_rolling_transfers (shared -> do not mutate).
+    Without data_version (the feature table version) the plan is solved and not cached.
+    """
+    max_transfers, allow_hits = transfer_strategy_settings(strategy, free_transfers)
+    # horizon + 2 GWs so every planned GW has its full 3-GW ROI window
+    solve = lambda: plan_transfers(current_squad_ids, bank, free_transfers, all_players, fixtures_df, teams_df, current_event,
+                                   horizon=horizon, picks_data=picks_data, allow_hits=allow_hits, max_transfers=max_transfers,
+                                   projections=get_projection_matrix(all_players, fixtures_df, teams_df, current_event, horizon + 2))
+    if data_version is None:
+        return solve()
+
+    sale_key = tuple(sorted((p['element'], p.get('selling_price'), p.get('purchase_price')) for p in picks_data or []))
+    key = (data_version, tuple(sorted(current_squad_ids)), round(bank, 1), free_transfers, strategy, current_event, horizon, sale_key)
+    entry = _plan_cache.get(key)
+    if entry is None:
+        def build():
+            built = _plan_cache.get(key)
+            if built is None:
+                built = (solve(),) # wrapped so "no plan found" is cached too
+                with _plan_lock:
+                    _plan_cache[key] = built
+                    while len(_plan_cache) > TRANSFER_PLAN_CACHE_SIZE:
+                        _plan_cache.pop(next(iter(_plan_cache)))
+            return built
+        entry = single_flight(('transfer-plan',) + key, build)
+    return entry[0]
+
+def suggest_transfers(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, strategy: str, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, picks_data: List[Dict] = None, projections: Optional[pd.DataFrame] = None, data_version: Optional[str] = None) -> List[Dict]:
+    """This GW's moves from the multi-GW plan; falls back to the greedy search if no plan is found."""
+    plan = get_transfer_plan(current_squad_ids, bank, free_transfers, all_players, strategy, fixtures_df, teams_df, current_event,
+                             picks_data=picks_data, data_version=data_version)
+    if plan is not None:
+        return [dict(move) for move in plan['gws'][0]['moves']]
+    return suggest_transfers_greedy(current_squad_ids, bank, free_transfers, all_players, strategy, fixtures_df, teams_df, current_event,
+                                    picks_data=picks_data, projections=projections)
+
+def transfer_gain_matrix(squad_ids: List[int], bank: float, all_players: pd.DataFrame, roi_xp: pd.Series, sale: Dict[int, Tuple[float, float]]) -> pd.DataFrame:
+    """
+    3-GW ROI gain of every single swap: squad players (rows, in the given order) × eligible candidates
+    (columns, best pred_points first), -inf where position, budget (bank + selling price) or the
+    3-per-club limit rule it out. sale: {squad id: (selling price in 0.1m, price loss)}.
+    """
+    squad = all_players.loc[squad_ids]
+    pool = all_players[~all_players.index.isin(squad_ids)
+                       & (all_players['chance_of_playing_next_round'] > 75)
+                       & all_players['pred_points'].notna()]
+    pool = pool.iloc[np.argsort(-pool['pred_points'].to_numpy(dtype=float), kind='stable')]
+
+    out_pos = squad['element_type'].to_numpy()[:, None]
+    out_team = squad['team'].to_numpy()[:, None]
+    sell_price = np.array([sale[pid][0] for pid in squad_ids], dtype=float)[:, None]
+    in_team = pool['team'].to_numpy()[None, :]
+    club_count = squad['team'].value_counts().reindex(pool['team']).fillna(0).to_numpy()[None, :]
+
+    allowed = ((pool['element_type'].to_numpy()[None, :] == out_pos)
+               & (pool['now_cost'].to_numpy()[None, :] / 10.0 <= bank + sell_price / 10.0)
+               & (club_count - (in_team == out_team) < SQUAD_CLUB_LIMIT))
+    gain = roi_xp.reindex(pool.index).to_numpy()[None, :] - roi_xp.reindex(squad_ids).to_numpy()[:, None]
+    gain = np.where(allowed & ~np.isnan(gain), gain, -np.inf)
+    return pd.DataFrame(gain, index=squad_ids, columns=pool.index)
+
+def suggest_transfers_greedy(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, strategy: str, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, picks_data: List[Dict] = None, projections: Optional[pd.DataFrame] = None) -> List[Dict]:
+    """Greedy single-swap search (fallback when the MILP planner finds no solution)."""
+    # projections: players × GWs matrix from current_event (see get_projection_matrix), built here if not given
+    if projections is None:
+        projections = get_projection_matrix(all_players, fixtures_df, teams_df, current_event, 3)
+    roi_xp = projections.iloc[:, :3].sum(axis=1)
+
     # 1. Setup Simulation State
     sim_squad_ids = [pid for pid in current_squad_ids if pid in all_players.index]
     if not sim_squad_ids: return []
     
     sim_bank = bank
     sim_free_transfers = free_transfers
-    
-    # Strategy Settings
-    if strategy == "Free Transfer": 
-        max_transfers = free_transfers
-        allow_hits = False
-    elif strategy == "Allow Hit (AI Suggest)": 
-        max_transfers = 5
-        allow_hits = True
-    else: 
-        max_transfers = 15
-        allow_hits = False
-
-    # Helper: Purchase Price Map
-    purchase_price_map = {}
-    if picks_data:
-        for p in picks_data:
-            if 'purchase_price' in p:
-                purchase_price_map[p['element']] = p['purchase_price']
+    max_transfers, allow_hits = transfer_strategy_settings(strategy, free_transfers)
+    # Selling price / price loss per squad player; players bought during the search sell at cost
+    sale = {pid: _sale_terms(pid, all_players.at[pid, 'now_cost'], picks_data) for pid in sim_squad_ids}
 
     final_moves = []
     
-    # 2. Iterative Greedy Search
+    # 2. Iterative Greedy Search over the full out × in gain matrix
     for _ in range(max_transfers):
-        # Current State Calculations
-        current_team_counts = {}
-        for pid in sim_squad_ids:
-            tid = int(all_players.loc[pid, 'team'])
-            current_team_counts[tid] = current_team_counts.get(tid, 0) + 1
-            
-        best_move = None
-        best_net_gain = float('-inf')
-        
         # Determine Hit Cost for this step
         if sim_free_transfers > 0:
             step_hit_cost = 0
         else:
             if not allow_hits: break # No more FTs and hits not allowed
             step_hit_cost = 4
-            
-        # Group current squad by position
-        position_groups = {1: [], 2: [], 3: [], 4: []}
-        for pid in sim_squad_ids:
-            position_groups.setdefault(int(all_players.loc[pid, 'element_type']), []).append(pid)
-            
-        # Search all possible single moves
-        for pos in [1, 2, 3, 4]:
-            out_ids = position_groups.get(pos, [])
-            if not out_ids: continue
-            
-            for out_id in out_ids:
-                out_player = all_players.loc[out_id]
-                
-                # Calculate Sell Price & Bank
-                price_loss = 0.0
-                purchase_price = purchase_price_map.get(out_id)
-                if purchase_price and picks_data:
-                    pick_obj = next((p for p in picks_data if p['element'] == out_id), None)
-                    if pick_obj and 'selling_price' in pick_obj:
-                        selling_price = pick_obj['selling_price']
-                    else:
-                        selling_price = out_player['now_cost']
-                        
-                    if purchase_price > selling_price:
-                        price_loss = (purchase_price - selling_price) / 10.0
-                else:
-                    selling_price = out_player['now_cost']
-                
-                sell_price_val = selling_price / 10.0
-                available_budget = sim_bank + sell_price_val
-                
-                # Find Candidates (IN)
-                candidates = all_players[
-                    (all_players['element_type'] == pos) &
-                    (~all_players.index.isin(sim_squad_ids)) &
-                    ((all_players['now_cost'] / 10.0) <= available_budget) &
-                    (all_players['chance_of_playing_next_round'] > 75)
-                ]
-                
-                if candidates.empty: continue
-                
-                # Filter Team Limits (taking into account the player leaving)
-                out_team = int(out_player['team'])
-                
-                def can_add_dynamic(pid):
-                    in_team = int(all_players.loc[pid, 'team'])
-                    current_count = current_team_counts.get(in_team, 0)
-                    if in_team == out_team:
-                        current_count -= 1
-                    return current_count < 3
-                
-                candidates = candidates[candidates.index.map(can_add_dynamic)]
-                if candidates.empty: continue
-                
-                # Optimization: Look at top 5 by predicted points
-                top_candidates = candidates.nlargest(5, 'pred_points')
-                
-                for _, best_in in top_candidates.iterrows():
-                    in_id = int(best_in.name)
-                    
-                    # ROI Calculation
-                    roi = calculate_transfer_roi(out_id, in_id, current_event, all_players, fixtures_df, teams_df, hit_cost=0)
-                    gross_gain = roi['gross_gain']
-                    
-                    # Apply Price Lock Penalty
-                    warning_msg = ""
-                    adjusted_gross_gain = gross_gain
-                    if price_loss > 0.3:
-                        adjusted_gross_gain -= 0.5
-                        warning_msg = "⚠️ Selling at loss"
-                        
-                    net_gain = adjusted_gross_gain - step_hit_cost
-                    
-                    if net_gain > best_net_gain:
-                        best_net_gain = net_gain
-                        best_move = {
-                            "out_id": out_id,
-                            "in_id": in_id,
-                            "out_name": out_player['web_name'],
-                            "out_cost": sell_price_val,
-                            "in_name": best_in['web_name'],
-                            "in_cost": best_in['now_cost'] / 10.0,
-                            "delta_points": best_in['pred_points'] - out_player['pred_points'],
-                            "roi_3gw": gross_gain,
-                            "hit_cost": step_hit_cost,
-                            "net_gain": net_gain,
-                            "price_loss": price_loss,
-                            "warning": warning_msg
-                        }
-
-        # 3. Apply Best Move or Stop
-        if best_move and best_move['net_gain'] > 0:
-            final_moves.append(best_move)
-            
-            # Update Simulation State
-            sim_squad_ids.remove(best_move['out_id'])
-            sim_squad_ids.append(best_move['in_id'])
-            sim_bank += (best_move['out_cost'] - best_move['in_cost'])
-            
-            if sim_free_transfers > 0:
-                sim_free_transfers -= 1
-                
-            purchase_price_map[best_move['in_id']] = all_players.loc[best_move['in_id'], 'now_cost']
-            
-        else:
-            break
+
+        # Rows by position (GK..FWD), squad order within a position -- the old search order for ties
+        out_ids = sorted(sim_squad_ids, key=lambda pid: all_players.at[pid, 'element_type'])
+        gain = transfer_gain_matrix(out_ids, sim_bank, all_players, roi_xp, sale)
+        if gain.empty: break
+
+        # Apply Price Lock Penalty
+        penalty = np.array([PRICE_LOSS_PENALTY if sale[pid][1] > 0.3 else 0.0 for pid in out_ids])
+        net = gain.to_numpy() - penalty[:, None] - step_hit_cost
+        row, col = np.unravel_index(np.argmax(net), net.shape)
+        if not net[row, col] > 0: break
+
+        out_id, in_id = out_ids[row], int(gain.columns[col])
+        selling_price, price_loss = sale[out_id]
+        move = {
+            "out_id": out_id,
+            "in_id": in_id,
+            "out_name": all_players.at[out_id, 'web_name'],
+            "out_cost": selling_price / 10.0,
+            "in_name": all_players.at[in_id, 'web_name'],
+            "in_cost": float(all_players.at[in_id, 'now_cost'] / 10.0),
+            "delta_points": all_players.at[in_id, 'pred_points'] - all_players.at[out_id, 'pred_points'],
+            "roi_3gw": gain.iat[row, col],
+            "hit_cost": step_hit_cost,
+            "net_gain": net[row, col],
+            "price_loss": price_loss,
+            "warning": "⚠️ Selling at loss" if penalty[row] else ""
+        }
+
+        # 3. Apply Best Move
+        final_moves.append(move)
+        sim_squad_ids.remove(out_id)
+        sim_squad_ids.append(in_id)
+        sim_bank += (move['out_cost'] - move['in_cost'])
+        sale[in_id] = (all_players.at[in_id, 'now_cost'], 0.0)
+        if sim_free_transfers > 0:
+            sim_free_transfers -= 1
             
     return final_moves
-    return final_moves
 
-def plan_rolling_transfers(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, horizon: int = 3) -> List[Dict]:
+def plan_rolling_transfers(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int, horizon: int = 3, picks_data: List[Dict] = None, strategy: str = "Free Transfer", data_version: Optional[str] = None) -> List[Dict]:
     """
     Simulates a rolling transfer strategy for the next 'horizon' gameweeks.
-    Decides whether to 'USE' or 'SAVE' FTs based on ROI.
+    Decides whether to 'USE' or 'SAVE' FTs based on ROI. Each step carries all of its 'moves' and its 'hits';
+    'net_gain' is after the hit cost. With the same arguments it reads the plan suggest_transfers used.
     """
+    # One matrix covers every step's 3-GW ROI window
+    projections = get_projection_matrix(all_players, fixtures_df, teams_df, current_event, horizon + 2)
+
+    # Multi-GW plan: the model itself decides when to bank FTs
+    milp = get_transfer_plan(current_squad_ids, bank, free_transfers, all_players, strategy, fixtures_df, teams_df, current_event,
+                             picks_data=picks_data, data_version=data_version, horizon=horizon)
+    if milp is not None:
+        plan = []
+        for step in milp['gws']:
+            moves = step['moves']
+            if not moves:
+                plan.append({"gw": step['gw'], "action": "HOLD", "details": "Save Free Transfer", "roi": 0.0, "net_gain": 0.0, "moves": [], "hits": 0})
+                continue
+            plan.append({
+                "gw": step['gw'],
+                "action": "TRANSFER",
+                "details": ", ".join(f"Sell {m['out_name']} -> Buy {m['in_name']}" for m in moves),
+                "roi": sum(m['roi_3gw'] for m in moves),
+                "net_gain": sum(m['net_gain'] for m in moves), # hit shares included
+                "moves": [dict(m) for m in moves],
+                "hits": step['hits']
+            })
+        return plan
+
+    # Fallback: step-by-step greedy simulation
     plan = []
     sim_squad = set(current_squad_ids)
     sim_bank = bank
@@ -1034,9 +1534,10 @@ def plan_rolling_transfers(current_squad_ids: List[int], bank: float, free_trans
         
         # 1. Get Suggestions for this simulated state
         # We use 'Free Transfer' strategy to see best FT moves
-        suggestions = suggest_transfers(list(sim_squad), sim_bank, sim_ft, all_players, "Free Transfer", fixtures_df, teams_df, gw)
+        suggestions = suggest_transfers_greedy(list(sim_squad), sim_bank, sim_ft, all_players, "Free Transfer", fixtures_df, teams_df, gw,
+                                               picks_data=picks_data, projections=projections.iloc[:, step:step + 3])
         
-        action = {"gw": gw, "action": "HOLD", "details": "Save Free Transfer", "roi": 0.0, "net_gain": 0.0}
+        action = {"gw": gw, "action": "HOLD", "details": "Save Free Transfer", "roi": 0.0, "net_gain": 0.0, "moves": [], "hits": 0}
         
         if suggestions:
             best_move = suggestions[0] # Best move by Net Gain
@@ -1050,170 +1551,147 @@ def plan_rolling_transfers(current_squad_ids: List[int], bank: float, free_trans
                     "details": f"Sell {best_move['out_name']} -> Buy {best_move['in_name']}",
                     "roi": best_move['roi_3gw'],
                     "net_gain": best_move['net_gain'],
-                    "in_id": best_move['in_id'],
-                    "out_id": best_move['out_id'],
-                    "in_cost": best_move['in_cost'],
-                    "out_cost": best_move['out_cost']
+                    "moves": [best_move],
+                    "hits": 0
                 }
 
         plan.append(action)
         
         # Update State for next loop
         if action['action'] == "TRANSFER":
-            if action['out_id'] in sim_squad:
-                sim_squad.remove(action['out_id'])
-            sim_squad.add(action['in_id'])
-            sim_bank += (action['out_cost'] - action['in_cost'])
+            for move in action['moves']:
+                sim_squad.discard(move['out_id'])
+                sim_squad.add(move['in_id'])
+                sim_bank += (move['out_cost'] - move['in_cost'])
             sim_ft = max(1, sim_ft - 1) # Used 1 FT
         else:
             sim_ft = min(5, sim_ft + 1) # Saved FT, max 5
             
     return plan
 
+# --- NEW: Wildcard Model (array-built, dominance-pruned) ---
+SQUAD_QUOTAS = {1: 2, 2: 5, 3: 5, 4: 3}
+SQUAD_CLUB_LIMIT = 3
+
+def dominated_players(all_players: pd.DataFrame) -> pd.Series:
+    """
+    True for players no optimal wildcard squad can contain: in their position, players from at least
+    quota + 4 distinct clubs cost no more and score strictly more. A squad holding such a player has at
+    most quota - 1 of them and at most 4 other full clubs, so one of them always swaps in for a gain.
+    """
+    points = all_players['pred_points'].astype(float).fillna(0).to_numpy()
+    cost = all_players['now_cost'].to_numpy()
+    positions = all_players['element_type'].to_numpy()
+    club_codes, _ = pd.factorize(all_players['team'])
+    dominated = np.zeros(len(all_players), dtype=bool)
+
+    for pos, quota in SQUAD_QUOTAS.items():
+        members = np.flatnonzero(positions == pos)
+        if len(members) <= quota + 4:
+            continue
+        members = members[np.argsort(cost[members], kind='stable')]
+        pos_cost, pos_points = cost[members], points[members]
+        # best[c, k] = best points of club c among the k+1 cheapest; read at the last player costing <= ours
+        best = np.full((club_codes.max() + 1, len(members)), -np.inf)
+        best[club_codes[members], np.arange(len(members))] = pos_points
+        best = np.maximum.accumulate(best, axis=1)
+        cheaper_or_equal = np.searchsorted(pos_cost, pos_cost, side='right') - 1
+        better_clubs = (best[:, cheaper_or_equal] > pos_points).sum(axis=0)
+        dominated[members] = better_clubs >= quota + 4
+    return pd.Series(dominated, index=all_players.index)
+
 def optimize_wildcard_team(all_players: pd.DataFrame, budget: float) -> Optional[List[int]]:
-    ids = list(all_players.index)
-    teams = all_players['team'].unique()
+    pool = all_players[~dominated_players(all_players)]
+    ids = list(pool.index)
+    points = pool['pred_points'].astype(float).fillna(0).tolist()
+    cost = pool['now_cost'].astype(float).tolist()
+    positions = pool['element_type'].to_numpy()
+    clubs = pool['team'].to_numpy()
+
     prob = LpProblem("Wildcard_Optimization", LpMaximize)
-    x = {i: LpVariable(f"x_{i}", cat=LpBinary) for i in ids}
-    
-    prob += lpSum([all_players.loc[i, 'pred_points'] * x[i] for i in ids])
-    prob += lpSum([all_players.loc[i, 'now_cost'] * x[i] for i in ids]) <= budget * 10
-    prob += lpSum([x[i] for i in ids]) == 15
-    prob += lpSum([x[i] for i in ids if all_players.loc[i, 'element_type'] == 1]) == 2
-    prob += lpSum([x[i] for i in ids if all_players.loc[i, 'element_type'] == 2]) == 5
-    prob += lpSum([x[i] for i in ids if all_players.loc[i, 'element_type'] == 3]) == 5
-    prob += lpSum([x[i] for i in ids if all_players.loc[i, 'element_type'] == 4]) == 3
-    for team_id in teams: prob += lpSum([x[i] for i in ids if all_players.loc[i, 'team'] == team_id]) <= 3
-    
+    x = [LpVariable(f"x_{i}", cat=LpBinary) for i in ids]
+    prob += LpAffineExpression(zip(x, points))
+    prob += LpAffineExpression(zip(x, cost)) <= budget * 10
+    prob += lpSum(x) == sum(SQUAD_QUOTAS.values())
+    for pos, quota in SQUAD_QUOTAS.items():
+        prob += lpSum(x[k] for k in np.flatnonzero(positions == pos)) == quota
+    for club in np.unique(clubs):
+        prob += lpSum(x[k] for k in np.flatnonzero(clubs == club)) <= SQUAD_CLUB_LIMIT
+
     prob.solve(PULP_CBC_CMD(msg=0))
-    if LpStatus[prob.status] == 'Optimal': return [i for i in ids if x[i].value() == 1]
+    if LpStatus[prob.status] == 'Optimal': return [i for i, var in zip(ids, x) if var.value() == 1]
     return None
 
 def suggest_transfers_enhanced(current_squad_ids: List[int], bank: float, free_transfers: int, all_players: pd.DataFrame, strategy: str, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, current_event: int) -> Tuple[List[Dict], List[Dict]]:
-    normal_moves = suggest_transfers(current_squad_ids, bank, free_transfers, all_players, strategy, fixtures_df, teams_df, current_event)
+    """
+    (normal moves, conservative moves). The plan is solved once; the conservative list re-checks its
+    moves against selling prices marked down (max(-0.2m, -5%)) and the bank that leaves.
+    """
+    projections = get_projection_matrix(all_players, fixtures_df, teams_df, current_event, 3)
+    normal_moves = suggest_transfers(current_squad_ids, bank, free_transfers, all_players, strategy, fixtures_df, teams_df, current_event, projections=projections)
     
-    conservative_all_players = all_players.copy()
+    conservative_prices = {}
     for player_id in current_squad_ids:
         if player_id not in all_players.index: continue
         current_price = all_players.loc[player_id, 'selling_price']
-        conservative_price = max(current_price - 2, current_price * 0.95)
-        conservative_all_players.loc[player_id, 'selling_price'] = conservative_price
+        conservative_prices[player_id] = max(current_price - 2, current_price * 0.95)
     
     conservative_bank = bank
     for move in normal_moves:
-        if move['out_id'] not in all_players.index: continue
-        original_price = all_players.loc[move['out_id'], 'selling_price']
-        conservative_price = conservative_all_players.loc[move['out_id'], 'selling_price']
-        price_diff = (original_price - conservative_price) / 10.0
+        if move['out_id'] not in conservative_prices: continue
+        price_diff = (all_players.loc[move['out_id'], 'selling_price'] - conservative_prices[move['out_id']]) / 10.0
         conservative_bank = max(0, conservative_bank - price_diff)
     
-    conservative_moves = suggest_transfers(current_squad_ids, conservative_bank, free_transfers, conservative_all_players, strategy, fixtures_df, teams_df, current_event)
     filtered_conservative_moves = []
     remaining_bank = conservative_bank
     used_players = set()
     
-    for move in conservative_moves:
+    for move in normal_moves:
         if move['in_id'] not in used_players:
             cost_change = move['in_cost'] - move['out_cost']
             if cost_change <= remaining_bank:
-                if move['out_id'] in conservative_all_players.index:
-                    move['out_cost'] = round(conservative_all_players.loc[move['out_id'], 'selling_price'] / 10.0, 1)
-                    filtered_conservative_moves.append(move)
+                if move['out_id'] in conservative_prices:
+                    # Copy: the normal list keeps its own out_cost
+                    filtered_conservative_moves.append(dict(move, out_cost=round(conservative_prices[move['out_id']] / 10.0, 1)))
                     remaining_bank -= cost_change
                     used_players.add(move['in_id'])
     return normal_moves, filtered_conservative_moves
+
 def calculate_home_away_split(player_id: int) -> Dict[str, float]:
     """
     Fetches player history and calculates average points for Home vs Away games.
+    (The feature table already carries these columns for every player.)
     """
+    empty = {"home_avg": 0.0, "away_avg": 0.0, "home_games": 0, "away_games": 0}
     try:
-        history_data = get_player_history(player_id)
-        history = history_data.get("history", [])
-        
-        if not history:
-            return {"home_avg": 0.0, "away_avg": 0.0, "home_games": 0, "away_games": 0}
-            
-        home_points = []
-        away_points = []
-        
-        for match in history:
-            points = match.get("total_points", 0)
-            if match.get("was_home", False):
-                home_points.append(points)
-            else:
-                away_points.append(points)
-                
-        home_avg = sum(home_points) / len(home_points) if home_points else 0.0
-        away_avg = sum(away_points) / len(away_points) if away_points else 0.0
-        
+        splits = home_away_splits(build_history_frame({player_id: get_player_history(player_id)}))
+        if player_id not in splits.index:
+            return empty
+        split = splits.loc[player_id]
         return {
-            "home_avg": round(home_avg, 2),
-            "away_avg": round(away_avg, 2),
-            "home_games": len(home_points),
-            "away_games": len(away_points)
+            "home_avg": round(float(split['home_avg']), 2),
+            "away_avg": round(float(split['away_avg']), 2),
+            "home_games": int(split['home_games']),
+            "away_games": int(split['away_games'])
         }
     except Exception as e:
         print(f"Error calculating split for {player_id}: {e}")
-        return {"home_avg": 0.0, "away_avg": 0.0, "home_games": 0, "away_games": 0}
+        return empty
 
-def analyze_player_history(player_id: int) -> Dict[str, any]:
+def analyze_player_history(player_id: int, history_data: Optional[Dict] = None, window: int = FORM_WINDOW) -> Dict[str, any]:
     """
-    Analyzes a player's history to calculate weighted form and trend.
-    Fetches element-summary from API (using cached helper).
+    Analyzes a player's history to calculate weighted form and trend (single-player view of player_form_metrics).
+    Uses history_data when given, otherwise fetches element-summary from API (using cached helper).
     """
+    empty = {'weighted_form': 0.0, 'form_trend': "➖", 'avg_minutes': 0.0, 'points_variance': 0.0}
     try:
-        data = get_player_history(player_id)
-        if not data: return {'weighted_form': 0.0, 'form_trend': "➖", 'avg_minutes': 0.0, 'points_variance': 0.0}
-        
-        history = data.get('history', [])
-        
-        if not history: return {'weighted_form': 0.0, 'form_trend': "➖", 'avg_minutes': 0.0, 'points_variance': 0.0}
-        
-        # Sort by round (descending)
-        history.sort(key=lambda x: x['round'], reverse=True)
-        last_5 = history[:5]
-        
-        if not last_5: return {'weighted_form': 0.0, 'form_trend': "➖", 'avg_minutes': 0.0, 'points_variance': 0.0}
-        
-        # Weighted Form
-        total_weight = 0
-        weighted_sum = 0
-        minutes_sum = 0
-        points_list = []
-        
-        for i, match in enumerate(last_5):
-            pts = match['total_points']
-            mins = match['minutes']
-            weight = 5 - i # 5, 4, 3, 2, 1
-            
-            weighted_sum += pts * weight
-            total_weight += weight
-            minutes_sum += mins
-            points_list.append(pts)
-            
-        weighted_form = weighted_sum / total_weight
-        avg_minutes = minutes_sum / len(last_5)
-        
-        # Form Trend
-        trend = "➖"
-        if len(last_5) >= 2:
-            recent_avg = sum(m['total_points'] for m in last_5[:2]) / 2
-            older_avg = sum(m['total_points'] for m in last_5[2:]) / max(1, len(last_5)-2)
-            if recent_avg > older_avg + 1.5: trend = "🔥"
-            elif recent_avg < older_avg - 1.5: trend = "📉"
-            
-        # Variance Calculation
-        points_variance = np.var(points_list) if len(points_list) > 1 else 0.0
-            
-        return {
-            'weighted_form': weighted_form,
-            'form_trend': trend,
-            'avg_minutes': avg_minutes,
-            'points_variance': points_variance
-        }
-        
+        data = history_data if history_data is not None else get_player_history(player_id)
+        form = player_form_metrics(build_history_frame({player_id: data}), window=window)
+        if player_id not in form.index:
+            return empty
+        return form.loc[player_id].to_dict()
     except Exception:
-        return {'weighted_form': 0.0, 'form_trend': "➖", 'avg_minutes': 0.0, 'points_variance': 0.0}
+        return empty
 
 def suggest_chip_usage(current_gw: int, chips_history: List[Dict], fixtures_df: pd.DataFrame, teams_df: pd.DataFrame, squad_df: pd.DataFrame) -> List[Dict]:
     """
@@ -1241,9 +1719,9 @@ def suggest_chip_usage(current_gw: int, chips_history: List[Dict], fixtures_df:
     dgw_gws = [] # Gameweeks with Double Games
     bgw_gws = [] # Gameweeks with Blanks
     
+    counts = fixture_counts(get_fixture_index(fixtures_df, teams_df), future_gws)
     for gw in future_gws:
-        gw_fixtures = fixtures_df[fixtures_df['event'] == gw]
-        team_counts = gw_fixtures['team_h'].value_counts().add(gw_fixtures['team_a'].value_counts(), fill_value=0)
+        team_counts = counts[gw]
         
         # DGW: Any team plays > 1 game
         if (team_counts > 1).any():
@@ -1251,7 +1729,7 @@ def suggest_chip_usage(current_gw: int, chips_history: List[Dict], fixtures_df:
             dgw_gws.append({'gw': gw, 'teams': dgw_teams})
             
         # BGW: Count of teams playing < 1 game (Total teams = 20)
-        teams_playing = len(team_counts)
+        teams_playing = int((team_counts > 0).sum())
         if teams_playing < 20:
             bgw_gws.append({'gw': gw, 'teams_playing': teams_playing})
 
@@ -0,0 +1,115 @@
+"""
+Record/replay fixtures for data_helpers and a local HTTP stand-in that serves them.
+
+Record:  FPL_DATA_MODE=record FPL_FIXTURE_DIR=fixtures/gw10 streamlit run fpl.py
+Replay:  FPL_DATA_MODE=replay FPL_FIXTURE_DIR=fixtures/gw10 streamlit run fpl.py
+         (data_helpers starts the stand-in in-process, or set FPL_REPLAY_URL to a running one)
+Serve:   python stub_server.py fixtures/gw10 --port 8765
+
+A fixture directory holds one body file per recorded URL plus manifest.json:
+    {"format": 1, "created_at": ..., "responses": {"<host><path>?<query>": {"file", "content_type", "etag"}}}
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+FIXTURE_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+_manifest_lock = threading.Lock()
+_recording_manifests = {}
+
+def fixture_key(url: str) -> str:
+    """Scheme-less key used both as manifest key and as the stand-in's request path."""
+    parts = urlsplit(url)
+    key = f"{parts.netloc}{parts.path}"
+    return f"{key}?{parts.query}" if parts.query else key
+
+def load_manifest(fixture_dir: str) -> Dict:
+    try:
+        with open(os.path.join(fixture_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"format": FIXTURE_FORMAT_VERSION, "created_at": time.time(), "responses": {}}
+    if manifest.get("format") != FIXTURE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported fixture format {manifest.get('format')} in {fixture_dir}")
+    return manifest
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def record_response(fixture_dir: str, url: str, body: bytes, content_type: Optional[str], etag: Optional[str] = None):
+    """Stores one response body and registers it in the manifest (last recording of a URL wins)."""
+    key = fixture_key(url)
+    ext = ".json" if content_type and "json" in content_type else ".body"
+    file_name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + ext
+    with _manifest_lock:
+        os.makedirs(fixture_dir, exist_ok=True)
+        _write_atomic(os.path.join(fixture_dir, file_name), body)
+        manifest = _recording_manifests.get(fixture_dir)
+        if manifest is None:
+            manifest = _recording_manifests[fixture_dir] = load_manifest(fixture_dir)
+        manifest["responses"][key] = {"file": file_name, "content_type": content_type, "etag": etag}
+        _write_atomic(os.path.join(fixture_dir, MANIFEST_NAME), json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+
+def _make_handler(fixture_dir: str, manifest: Dict):
+    responses = manifest["responses"]
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, like the real upstreams
+
+        def do_GET(self):
+            entry = responses.get(self.path.lstrip("/"))
+            if entry is None:
+                self._send(404, b"", "text/plain")
+                return
+            if entry.get("etag") and self.headers.get("If-None-Match") == entry["etag"]:
+                self._send(304, b"", None, entry["etag"])
+                return
+            with open(os.path.join(fixture_dir, entry["file"]), "rb") as f:
+                body = f.read()
+            self._send(200, body, entry.get("content_type"), entry.get("etag"))
+
+        def _send(self, status: int, body: bytes, content_type: Optional[str], etag: Optional[str] = None):
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # quiet: replay runs under load tests
+
+    return ReplayHandler
+
+def start_replay_server(fixture_dir: str, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Starts the stand-in on a daemon thread; the bound port is server.server_address[1]."""
+    server = ThreadingHTTPServer((host, port), _make_handler(fixture_dir, load_manifest(fixture_dir)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fpl-replay-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded FPL/Understat/FotMob responses over HTTP.")
+    parser.add_argument("fixture_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    manifest = load_manifest(args.fixture_dir)
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(args.fixture_dir, manifest))
+    server.daemon_threads = True
+    print(f"Replaying {len(manifest['responses'])} responses from {args.fixture_dir} on http://{args.host}:{args.port}")
+    print(f"Run the app with FPL_DATA_MODE=replay FPL_REPLAY_URL=http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,238 @@
+"""
+Golden test: the vectorized passes in engineer_features_enhanced against the original per-row
+(DataFrame.apply) implementations they replaced. Runs offline on a synthetic player pool.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fpl_logic  # noqa: E402
+from data_helpers import _minutes_lookup, normalize_name  # noqa: E402
+
+GAMEWEEK = 9
+N_TEAMS = 20
+N_PLAYERS = 400
+
+# --- Per-row reference implementations (as they were before vectorization) ---
+
+def ref_set_piece_role(row):
+    roles = []
+    notes = []
+    pen_order = row.get('penalties_order')
+    if pd.notnull(pen_order):
+        if pen_order == 1:
+            roles.append('Penalty')
+            notes.append("Primary Penalty Taker")
+        elif pen_order <= 2:
+            notes.append("Backup Penalty Taker")
+    fk_order = row.get('direct_freekicks_order')
+    if pd.notnull(fk_order):
+        if fk_order == 1:
+            roles.append('Free Kick')
+            notes.append("Direct Free Kick Taker")
+    corner_order = row.get('corners_and_indirect_freekicks_order')
+    if pd.notnull(corner_order):
+        if corner_order == 1:
+            roles.append('Corner')
+            notes.append("Primary Corner Taker")
+        elif corner_order <= 2:
+            notes.append("Shared Corner Duties")
+    return roles, " | ".join(notes)
+
+def ref_midweek_rotation(row, midweek_cache):
+    current_xmins = row['xMins']
+    mw_data = midweek_cache.get(row['team'], {})
+    if not mw_data:
+        return current_xmins
+    if mw_data.get('hours_gap', 999) < 72:
+        web_name = normalize_name(row['web_name'])
+        full_name = normalize_name(f"{row['first_name']} {row['second_name']}")
+        for name, v in mw_data.get('player_minutes', {}).items():
+            k_norm = normalize_name(name)
+            if web_name == k_norm or k_norm in full_name or full_name in k_norm:
+                if v > 60:
+                    return min(current_xmins, 60.0)
+                elif v == 0:
+                    return min(90.0, current_xmins * 1.1)
+                break
+    return current_xmins
+
+def ref_aerial_threat(row):
+    threat_per_90 = (row['threat'] / row['minutes']) * 90 if row['minutes'] > 0 else 0
+    if row['element_type'] == 2 and threat_per_90 > 15:
+        return 1
+    if row['element_type'] == 3 and threat_per_90 > 25:
+        return 1
+    if row['element_type'] == 4 and threat_per_90 > 40:
+        return 1
+    return 0
+
+def ref_dynamic_pred(row, pos_mult):
+    base_score = float(row.get('base_xP', 0)) * pos_mult[int(row['element_type'])-1]
+    pos = row.get('element_type', 3)
+    if pos in [1, 2]:
+        fix_ease = row.get('fixture_ease_def', row.get('avg_fixture_ease', 0))
+    else:
+        fix_ease = row.get('fixture_ease_att', row.get('avg_fixture_ease', 0))
+    if fix_ease > 4: base_score *= 1.1
+    elif fix_ease < 2: base_score *= 0.9
+
+    sp_bonus = 0.0
+    roles = row.get('set_piece_roles', [])
+    if 'Penalty' in roles: sp_bonus += 1.0
+    if 'Free Kick' in roles: sp_bonus += 0.4
+    if 'Corner' in roles: sp_bonus += 0.3
+    if row.get('is_aerial_threat', 0): sp_bonus += 0.2
+
+    final_pred = (base_score + sp_bonus) * (row['xMins'] / 90.0)
+    num_fix = row.get('num_fixtures', 1)
+    if num_fix == 2: final_pred *= 1.6
+    elif num_fix == 0: final_pred = 0
+    return final_pred * float(row.get('venue_multiplier', 1.0))
+
+def ref_risk_level(sd):
+    if sd < 2.0: return "LOW"
+    elif sd < 4.0: return "MEDIUM"
+    else: return "HIGH"
+
+def ref_selection_score(player_row):
+    score = 0.0
+    score += player_row.get('pred_points', 0) * 0.4
+    if player_row.get('xG', 0) > 0 or player_row.get('xA', 0) > 0:
+        games_played_est = max(1, player_row.get('minutes', 0) / 90.0)
+        xgi_bonus = (player_row.get('xG', 0) * 5 + player_row.get('xA', 0) * 3) / games_played_est
+        score += xgi_bonus * 0.3
+    score += player_row.get('form', 0) * 0.15
+    score += player_row.get('avg_fixture_ease', 0) * 10 * 0.1
+    score += player_row.get('avg_fixture_ease', 0) * 10 * 0.1
+    play_prob = player_row.get('play_prob', 1.0)
+    if play_prob == 0:
+        score *= 0.0
+    elif play_prob < 0.5:
+        score *= 0.2
+    else:
+        score *= (0.5 + 0.5 * play_prob)
+    if player_row.get('num_fixtures', 1) == 2:
+        score *= 1.3
+    if player_row.get('num_fixtures', 1) == 0:
+        score = 0
+    return score
+
+def reference_row_passes(feat, history_ids, midweek_cache):
+    """Recomputes every formerly row-wise column of `feat` with the per-row code above."""
+    ref = feat.copy()
+    ref['avg_minutes'] = ref.apply(
+        lambda r: r['avg_minutes'] if r['id'] in history_ids else r['minutes'] / max(1, GAMEWEEK), axis=1)
+    ref['xMins'] = ref.apply(lambda x: min(90, x['avg_minutes'] * x['play_prob']), axis=1)
+    ref['xMins'] = ref.apply(ref_midweek_rotation, axis=1, midweek_cache=midweek_cache)
+    sp_analysis = ref.apply(ref_set_piece_role, axis=1)
+    ref['set_piece_roles'] = sp_analysis.apply(lambda x: x[0])
+    ref['set_piece_note'] = sp_analysis.apply(lambda x: x[1])
+    ref['is_aerial_threat'] = ref.apply(ref_aerial_threat, axis=1)
+    pos_mult = np.select([ref["element_type"] == t for t in (1, 2, 3, 4)], [0.9, 0.95, 1.0, 1.05], default=1.0)
+    ref['pred_points'] = ref.apply(ref_dynamic_pred, axis=1, pos_mult=pos_mult)
+    ref['floor'] = (ref['pred_points'] - np.sqrt(ref['points_variance'])).apply(lambda x: max(0, x))
+    ref['risk_level'] = np.sqrt(ref['points_variance']).apply(ref_risk_level)
+    ref['selection_score'] = ref.apply(ref_selection_score, axis=1)
+    return ref
+
+# --- Synthetic inputs ---
+
+def order_column(rng, n):
+    return pd.array(rng.choice([1, 2, 3, None], size=n, p=[0.1, 0.1, 0.1, 0.7]), dtype="Int64")
+
+def synthetic_pool(seed):
+    rng = np.random.default_rng(seed)
+    teams = pd.DataFrame({'id': np.arange(1, N_TEAMS + 1), 'short_name': [f"T{t:02d}" for t in range(1, N_TEAMS + 1)]})
+    minutes = np.where(rng.random(N_PLAYERS) < 0.15, 0, rng.integers(1, 810, N_PLAYERS))
+    elements = pd.DataFrame({
+        'id': np.arange(1, N_PLAYERS + 1),
+        'code': rng.integers(10000, 99999, N_PLAYERS),
+        'web_name': [f"Player{i:04d}" for i in range(N_PLAYERS)],
+        'first_name': [f"First{i:04d}" for i in range(N_PLAYERS)],
+        'second_name': [f"Player{i:04d}" for i in range(N_PLAYERS)],
+        'team': rng.integers(1, N_TEAMS + 1, N_PLAYERS),
+        'element_type': rng.integers(1, 5, N_PLAYERS),
+        'form': rng.uniform(0, 9, N_PLAYERS).round(1).astype(str),
+        'points_per_game': rng.uniform(0, 8, N_PLAYERS).round(1).astype(str),
+        'ict_index': rng.uniform(0, 120, N_PLAYERS).round(1).astype(str),
+        'selected_by_percent': rng.uniform(0, 60, N_PLAYERS).round(1).astype(str),
+        'total_points': rng.integers(0, 120, N_PLAYERS),
+        'now_cost': rng.integers(40, 140, N_PLAYERS),
+        'minutes': minutes,
+        'threat': rng.uniform(0, 500, N_PLAYERS).round(1).astype(str),
+        'influence': rng.uniform(0, 500, N_PLAYERS).round(1).astype(str),
+        'creativity': rng.uniform(0, 500, N_PLAYERS).round(1).astype(str),
+        'cost_change_event': rng.integers(-1, 2, N_PLAYERS),
+        'chance_of_playing_next_round': pd.array(rng.choice([0, 25, 50, 75, 100, None], size=N_PLAYERS), dtype="Int64"),
+        'penalties_order': order_column(rng, N_PLAYERS),
+        'direct_freekicks_order': order_column(rng, N_PLAYERS),
+        'corners_and_indirect_freekicks_order': order_column(rng, N_PLAYERS),
+    })
+    fpl_logic.add_normalized_names(elements)
+
+    # Team 1 blanks (no row -> NaN venue_multiplier), every fifth team doubles
+    fixture_teams = np.arange(2, N_TEAMS + 1)
+    nf = pd.DataFrame({
+        'team': fixture_teams,
+        'num_fixtures': np.where(fixture_teams % 5 == 0, 2, 1),
+        'avg_fixture_ease': rng.uniform(0, 6, len(fixture_teams)),
+        'fixture_ease_def': rng.uniform(0, 6, len(fixture_teams)),
+        'fixture_ease_att': rng.uniform(0, 6, len(fixture_teams)),
+        'opponent_str': [f"OPP{t}" for t in fixture_teams],
+        'venue_multiplier': rng.choice([0.95, 1.05], size=len(fixture_teams)),
+    })
+
+    # A third of the pool has no history (failed fetch -> season-average fallbacks)
+    histories = {}
+    for pid in elements['id'][rng.random(N_PLAYERS) > 0.33]:
+        n_matches = int(rng.integers(1, GAMEWEEK + 1))
+        histories[int(pid)] = {'history': [
+            {'round': r, 'total_points': int(rng.integers(-2, 16)), 'minutes': int(rng.integers(0, 91)),
+             'was_home': bool(rng.random() < 0.5)}
+            for r in range(GAMEWEEK - n_matches + 1, GAMEWEEK + 1)
+        ]}
+
+    # Last club match: teams 2-9 played 48h ago (rotation applies), team 10 four days ago (ignored).
+    # Lineups mix fatigued (> 60 min), rested (0 min) and part-time players; the rest of each squad is absent.
+    midweek = {}
+    for team in range(2, 11):
+        squad = elements[elements['team'] == team]
+        picked = squad.sample(frac=0.6, random_state=int(rng.integers(1 << 31)))
+        player_minutes = {f"{r.first_name} {r.second_name}": int(rng.choice([0, 0, 30, 75, 90])) for r in picked.itertuples()}
+        midweek[team] = {'hours_gap': 48.0 if team < 10 else 96.0, 'player_minutes': player_minutes,
+                         'minutes_lookup': _minutes_lookup(player_minutes)}
+
+    understat = pd.DataFrame({
+        'player_name': elements['web_name'][::3].tolist(),
+        'xG': rng.uniform(0, 8, len(elements[::3])),
+        'xA': rng.uniform(0, 5, len(elements[::3])),
+    })
+    return elements, teams, nf, histories, understat, midweek
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("with_understat", [False, True])
+def test_engineer_features_matches_per_row_reference(monkeypatch, seed, with_understat):
+    elements, teams, nf, histories, understat, midweek = synthetic_pool(seed)
+    monkeypatch.setattr(fpl_logic, 'get_player_histories', lambda ids: {pid: histories.get(pid) for pid in ids})
+    monkeypatch.setattr(fpl_logic, 'get_midweek_index', lambda team_ids: {t: midweek[t] for t in team_ids if t in midweek})
+
+    us_players = understat if with_understat else pd.DataFrame()
+    feat = fpl_logic.engineer_features_enhanced(elements, teams, nf, us_players, gameweek=GAMEWEEK)
+    ref = reference_row_passes(feat, set(histories), midweek)
+
+    for col in ['avg_minutes', 'xMins', 'is_aerial_threat', 'pred_points', 'floor', 'selection_score']:
+        np.testing.assert_array_equal(feat[col].to_numpy(dtype=float), ref[col].to_numpy(dtype=float), err_msg=col)
+    for col in ['set_piece_roles', 'set_piece_note', 'risk_level']:
+        assert feat[col].tolist() == ref[col].tolist(), col
+    # The synthetic pool exercises the fatigue cap, the fresh-legs boost and every role / note combination
+    base_xmins = np.minimum(90.0, (ref['avg_minutes'] * ref['play_prob']).to_numpy(dtype=float))
+    assert (feat['xMins'].to_numpy() < base_xmins).any()
+    assert (feat['xMins'].to_numpy() > base_xmins).any()
+    assert {tuple(r) for r in feat['set_piece_roles']} >= {(), ('Penalty',), ('Free Kick',), ('Corner',)}
+    assert feat['set_piece_note'].str.contains("Backup Penalty Taker").any()
+    assert feat['set_piece_note'].str.contains("Shared Corner Duties").any()
@@ -0,0 +1,30 @@
+"""build_history_frame must skip malformed element-summary records instead of failing the build."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fpl_logic  # noqa: E402
+
+
+def test_build_history_frame_drops_malformed_records():
+    histories = {
+        1: {'history': [
+            {'round': 3, 'total_points': 2, 'minutes': 90, 'was_home': True},
+            {'round': 4, 'minutes': 30},                               # no total_points
+            {'round': 'x', 'total_points': 1, 'minutes': 1},           # non-numeric round
+            {'round': 5, 'total_points': 5, 'minutes': 5},             # no was_home -> away
+        ]},
+        2: None,                                                      # failed fetch
+        3: {'history': None},
+        4: [1, 2],                                                    # not a dict
+        5: {'history': [None, {'round': 1, 'total_points': 7, 'minutes': 45}]},
+    }
+    frame = fpl_logic.build_history_frame(histories)
+    assert frame.to_dict('records') == [
+        {'player': 1, 'round': 5, 'points': 5, 'minutes': 5, 'was_home': False},
+        {'player': 1, 'round': 3, 'points': 2, 'minutes': 90, 'was_home': True},
+        {'player': 5, 'round': 1, 'points': 7, 'minutes': 45, 'was_home': False},
+    ]
+    # The rest of the pipeline runs on what is left
+    form = fpl_logic.player_form_metrics(frame)
+    assert list(form.index) == [1, 5]
@@ -919,9 +919,15 @@ def display_player_comparison(player1_data, player2_data):
             p2_id = int(player2_data.get('id', 0))
         
         if p1_id > 0 and p2_id > 0:
+            def venue_split(player_data, pid):
+                # Precomputed for every player in the feature table; fetch only if missing
+                if pd.notna(player_data.get('home_games')):
+                    return {k: player_data[k] for k in ('home_avg', 'away_avg', 'home_games', 'away_games')}
+                return calculate_home_away_split(pid)
+
             with st.spinner("Fetching split data..."):
-                p1_split = calculate_home_away_split(p1_id)
-                p2_split = calculate_home_away_split(p2_id)
+                p1_split = venue_split(player1_data, p1_id)
+                p2_split = venue_split(player2_data, p2_id)
             
             # Prepare data for chart
             # Helper to sanitize split values